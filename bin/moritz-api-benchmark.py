@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    moritz-api-benchmark
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Measures response time and size of the state API of moritz-server versus device count
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import imp
+import os
+import shutil
+import tempfile
+import time
+
+# environment imports
+
+# custom imports
+from moritzprotocol.communication import CULMessageThread
+from moritzprotocol.queues import BoundedQueue
+
+# local constants
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "moritz-server.py")
+PAYLOAD = {
+    'mode': 'auto',
+    'dstsetting': True,
+    'langateway': True,
+    'is_locked': False,
+    'rferror': False,
+    'battery_low': False,
+    'desired_temperature': 21.0,
+    'valve_position': 20,
+}
+VARIANTS = (
+    ("pretty", "/current_thermostat_states?pretty", {}),
+    ("compact", "/current_thermostat_states", {}),
+    ("gzip", "/current_thermostat_states", {'Accept-Encoding': 'gzip'}),
+    ("columns", "/current_thermostat_states?layout=columns", {}),
+)
+
+
+def main(args):
+    workdir = tempfile.mkdtemp()
+    try:
+        server = imp.load_source("moritz_server", SERVER_PATH)
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, "benchmark.db")
+        server.db.create_all()
+        client = server.app.test_client()
+        print "JSON backend: %s" % ("ujson" if server.fast_json is not None else "json")
+        for devices in args.devices:
+            message_thread = CULMessageThread(BoundedQueue(), "/dev/null")
+            for index in xrange(devices):
+                message_thread.thermostat_states.update(0x100000 + index, dict(PAYLOAD, measured_temperature=15 + index % 100 / 10.0), 0x20)
+            server.radio = server.LocalRadio(message_thread, server.command_queue)
+            for name, url, headers in VARIANTS:
+                durations = []
+                for _ in xrange(args.requests):
+                    began = time.time()
+                    response = client.get(url, headers=headers)
+                    durations.append(time.time() - began)
+                durations.sort()
+                print "%6i devices %-8s median %7.2fms p95 %7.2fms %8i bytes" % (
+                    devices, name, durations[len(durations) / 2] * 1000, durations[int(len(durations) * 0.95)] * 1000,
+                    len(response.get_data()))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 1000, 5000], help="Device counts to measure")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per device count and variant")
+    args = parser.parse_args()
+    main(args)
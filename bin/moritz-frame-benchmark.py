@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    moritz-frame-benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures time and memory allocations per received frame in CULMessageThread.process_frame
+
+    Allocations are traced with tracemalloc if available (Python 3.4+ or a patched Python 2.7
+    with pytracemalloc), reporting peak and retained memory blocks per frame. Without it only
+    objects retained by the garbage collector are counted.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import gc
+import Queue
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# environment imports
+import logbook
+
+# custom imports
+from moritzprotocol import communication
+from moritzprotocol.communication import CULMessageThread, CUBE_ID
+
+# local constants
+FIRST_SENDER_ID = 0x100000
+
+
+def generate_frames(count, devices):
+    """Returns thermostat state frames as received from CUL, no two of them duplicates"""
+
+    frames = []
+    for index in xrange(count):
+        device = index % devices
+        valve_position = index / devices % 101
+        frames.append("Z0F%02X0460%06X%06X000C%02X2A%04X%02X" % (
+            index / devices % 0x100, FIRST_SENDER_ID + device, CUBE_ID, valve_position, 180 + index % 50, 0x30))
+    return frames
+
+
+def measure(thread, frames):
+    gc.collect()
+    gc.disable()
+    try:
+        objects_before = len(gc.get_objects())
+        if tracemalloc is not None:
+            tracemalloc.start()
+        began = time.time()
+        for frame in frames:
+            thread.process_frame(frame)
+        duration = time.time() - began
+        result = {
+            'us_per_frame': duration / len(frames) * 1e6,
+            'retained_objects_per_frame': float(len(gc.get_objects()) - objects_before) / len(frames),
+        }
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+            tracemalloc.stop()
+            result['retained_blocks_per_frame'] = float(blocks) / len(frames)
+            result['retained_bytes_per_frame'] = float(current) / len(frames)
+            result['peak_kbytes'] = peak / 1024.0
+    finally:
+        gc.enable()
+    return result
+
+
+def main(args):
+    logbook.NullHandler().push_application()
+    if not args.with_logging:
+        # state changes get logged for each frame, which would dominate the result
+        communication.message_logger.disabled = True
+    thread = CULMessageThread(Queue.Queue(), "/dev/null")
+    # first frames of each device create its state slot and link quality entry
+    thread.duplicate_filter.window = 0
+    for frame in generate_frames(args.devices, args.devices):
+        thread.process_frame(frame)
+    frames = generate_frames(args.frames, args.devices)
+    print "tracemalloc: %s" % ("available" if tracemalloc is not None else "not available, counting retained objects only")
+    for name, value in sorted(measure(thread, frames).items()):
+        print "%-28s %10.2f" % (name, value)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=50, help="Devices sending frames, defaults to 50")
+    parser.add_argument("--frames", type=int, default=20000, help="Frames to process, defaults to 20000")
+    parser.add_argument("--with-logging", action="store_true", help="Include creation of log records for state changes")
+    args = parser.parse_args()
+    main(args)
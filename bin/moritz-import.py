@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    moritz-import
+    ~~~~~~~~~~~~~
+
+    Backfills thermostat state history of moritz-server from CUL captures, FHEM logs or moritz-server logs
+
+    Every line containing a timestamp and a raw Z... frame is streamed through decode, filter,
+    dedup and batched insert stages, so memory use does not depend on file size.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from datetime import datetime
+import mmap
+import re
+import struct
+import time
+
+# environment imports
+import logbook
+from sqlalchemy import MetaData, create_engine, select
+
+# custom imports
+from moritzprotocol.exceptions import MoritzError
+from moritzprotocol.messages import MoritzMessage, MODES_BY_NAME, MORITZ_MESSAGE_IDS, ThermostatStateMessage, AckMessage
+from moritzprotocol.states import ThermostatStates
+
+# local constants
+import_logger = logbook.Logger("MoritzImport")
+
+# FHEM logs use 2014-12-01_02:33:23, logbook and plain captures 2014-12-01 02:33:23
+TIMESTAMP_RE = re.compile(r"(\d{4}-\d{2}-\d{2})[ _T](\d{2}:\d{2}:\d{2})")
+FRAME_RE = re.compile(r"\b(Z[0-9A-Fa-f]{22,})\b")
+
+# message types carrying a thermostat state
+STATE_MESSAGE_TYPES = (ThermostatStateMessage, AckMessage)
+STATE_MESSAGE_IDS = dict((msgtype, message_class) for msgtype, message_class in MORITZ_MESSAGE_IDS.items()
+                         if message_class in STATE_MESSAGE_TYPES)
+
+STATE_COLUMNS = {
+    "rferror": "rferror",
+    "desired_temperature": "desired_temperature",
+    "is_locked": "is_locked",
+    "valve_position": "valve_position",
+    "langateway": "lan_gateway",
+    "dstsetting": "dstsetting",
+    "mode": "mode",
+    "measured_temperature": "measured_temperature",
+    "battery_low": "battery_low",
+}
+
+#
+# Pipeline stages
+#
+class Progress(object):
+    """Counts pipeline throughput and logs it every interval seconds"""
+
+    def __init__(self, total_bytes, interval=5):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.bytes_read = 0
+        self.lines = 0
+        self.frames = 0
+        self.skipped = 0
+        self.stored = 0
+        self.started = self._last_report = time.time()
+
+    def line_read(self, length):
+        self.bytes_read += length
+        self.lines += 1
+        if time.time() - self._last_report > self.interval:
+            self.report()
+
+    def report(self):
+        self._last_report = time.time()
+        elapsed = (self._last_report - self.started) or 1e-6
+        import_logger.info("%.1f%% read, %i lines (%i lines/s), %i frames, %i skipped, %i states stored" % (
+            100.0 * self.bytes_read / (self.total_bytes or 1), self.lines, self.lines / elapsed, self.frames,
+            self.skipped, self.stored))
+
+
+def read_lines(capture_file, progress):
+    """Yields lines of capture_file, memory-mapped so large files are not read into memory"""
+
+    if not progress.total_bytes:
+        return
+    mapped = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for line in iter(mapped.readline, ""):
+            progress.line_read(len(line))
+            yield line
+    finally:
+        mapped.close()
+
+
+def parse_frames(lines, progress):
+    """Yields (timestamp, frame) for lines holding both, frame still including signal strength if present"""
+
+    for line in lines:
+        frame = FRAME_RE.search(line)
+        if frame is None:
+            continue
+        timestamp = TIMESTAMP_RE.search(line)
+        if timestamp is None:
+            continue
+        progress.frames += 1
+        yield datetime.strptime(" ".join(timestamp.groups()), "%Y-%m-%d %H:%M:%S"), frame.group(1).upper()
+
+
+def decode_frames(frames, progress):
+    """Yields (timestamp, message, signal_strength), skipping undecodable frames"""
+
+    for timestamp, frame in frames:
+        signal_strength = None
+        # length byte tells whether the signal strength got appended by CUL
+        if len(frame) == 5 + int(frame[1:3], base=16) * 2:
+            frame, signal_strength = frame[:-2], int(frame[-2:], base=16)
+        try:
+            msg = MoritzMessage.decode_message(frame)
+        except (MoritzError, struct.error, ValueError, IndexError) as e:
+            progress.skipped += 1
+            import_logger.debug("Skipping frame %s: %s" % (frame, str(e)))
+            continue
+        yield timestamp, msg, signal_strength
+
+
+def filter_messages(messages, sender_ids=None, message_types=STATE_MESSAGE_TYPES):
+    """Yields only state carrying messages from given senders"""
+
+    for timestamp, msg, signal_strength in messages:
+        if sender_ids is not None and msg.sender_id not in sender_ids:
+            continue
+        if not isinstance(msg, message_types):
+            continue
+        if isinstance(msg, AckMessage) and len(msg.payload) != 8:
+            continue
+        yield timestamp, msg, signal_strength
+
+
+def dedup_states(messages, progress):
+    """Yields (timestamp, sender_id, changes, signal_strength) for messages changing a thermostat state"""
+
+    states = ThermostatStates()
+    for timestamp, msg, signal_strength in messages:
+        try:
+            payload = msg.decoded_payload
+        except NotImplementedError:
+            # message type without known content, nothing to store
+            continue
+        except (struct.error, ValueError, IndexError) as e:
+            # e.g. truncated payload, one bad line must not abort an import half committed
+            progress.skipped += 1
+            import_logger.debug("Skipping %s: %s" % (msg, str(e)))
+            continue
+        changes = states.update(msg.sender_id, payload, signal_strength, timestamp)
+        if changes:
+            yield timestamp, msg.sender_id, changes, signal_strength
+
+
+def batched(iterable, batch_size):
+    """Yields lists of up to batch_size items"""
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def store_states(engine, states, progress, batch_size=1000):
+    """Inserts states into thermostat_state table, ignoring senders unknown to moritz-server"""
+
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=["thermostat", "thermostat_state"])
+    thermostats = metadata.tables["thermostat"]
+    thermostat_states = metadata.tables["thermostat_state"]
+    thermostat_ids = dict(engine.execute(select([thermostats.c.sender_id, thermostats.c.id])).fetchall())
+
+    for batch in batched(states, batch_size):
+        rows = []
+        for timestamp, sender_id, changes, signal_strength in batch:
+            if sender_id not in thermostat_ids:
+                continue
+            row = dict((column, None) for column in STATE_COLUMNS.values())
+            row["thermostat_id"] = thermostat_ids[sender_id]
+            row["last_updated"] = timestamp
+            row["signal_strength"] = signal_strength
+            for field, value in changes.items():
+                if field in STATE_COLUMNS:
+                    row[STATE_COLUMNS[field]] = value
+            if "mode" in changes:
+                # stored as MODE_IDS like moritz-server does
+                row["mode"] = MODES_BY_NAME.get(changes["mode"])
+            rows.append(row)
+        if rows:
+            with engine.begin() as connection:
+                connection.execute(thermostat_states.insert(), rows)
+            progress.stored += len(rows)
+
+#
+# Execution
+#
+def main(args):
+    message_types = tuple(STATE_MESSAGE_IDS[int(msgtype, base=16)] for msgtype in args.type) \
+        if args.type else STATE_MESSAGE_TYPES
+    sender_ids = set(int(sender_id, base=16) for sender_id in args.sender) if args.sender else None
+    engine = create_engine(args.database)
+
+    with open(args.capture_file, "rb") as capture_file:
+        capture_file.seek(0, 2)
+        progress = Progress(capture_file.tell())
+        lines = read_lines(capture_file, progress)
+        messages = decode_frames(parse_frames(lines, progress), progress)
+        states = dedup_states(filter_messages(messages, sender_ids, message_types), progress)
+        store_states(engine, states, progress, args.batch_size)
+    progress.report()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture_file", help="CUL capture, FHEM log or moritz-server log to import")
+    parser.add_argument("--database", default="sqlite:///moritz-server.db", help="Database of moritz-server, defaults to sqlite:///moritz-server.db")
+    parser.add_argument("--sender", action="append", help="Only import states of given sender id (hex), may be repeated")
+    parser.add_argument("--type", action="append", choices=sorted("%02X" % msgtype for msgtype in STATE_MESSAGE_IDS), type=str.upper,
+                        help="Only import state carrying messages of given type id (hex), may be repeated. Defaults to thermostat states and acks")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows to insert per transaction")
+    args = parser.parse_args()
+
+    from logbook.more import ColorizedStderrHandler
+    log_handler = ColorizedStderrHandler()
+    log_handler.push_application()
+
+    main(args)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    moritz-loadtest
+    ~~~~~~~~~~~~~~~
+
+    Drives the HTTP API of moritz-server with concurrent clients while the radio is simulated.
+
+    The server runs in this process against a SimulatedCUL with the given amount of
+    thermostats. Clients fire a weighted mix of state, history and command requests, e.g.
+    --mix states=6,history=2,set_temp=2. Reported are throughput and latency percentiles per
+    request kind, queue fill levels sampled during the run and the time from posting a
+    command until the thermostat acknowledged it.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import argparse
+from collections import defaultdict
+import imp
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+# environment imports
+import logbook
+from werkzeug.serving import make_server
+
+# custom imports
+from moritzprotocol.messages import SetTemperatureMessage
+from moritzprotocol.queues import OVERFLOW_POLICIES
+from moritzprotocol.signals import command_acknowledged
+from moritzprotocol.simulation import SimulatedCUL
+
+# local constants
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "moritz-server.py")
+FIRST_SENDER_ID = 0x100000
+REQUEST_KINDS = ("states", "columns", "history", "set_temp")
+
+
+def percentiles(durations):
+    if not durations:
+        return "no samples"
+    durations = sorted(durations)
+    return "p50 %8.1fms p90 %8.1fms p99 %8.1fms max %8.1fms" % tuple(
+        durations[min(int(len(durations) * share), len(durations) - 1)] * 1000 for share in (0.5, 0.9, 0.99, 1.0))
+
+
+class Results(object):
+    """Request durations and status codes per kind plus command acknowledgement times"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        # receiver_id: (post time, temperature) of commands not acknowledged yet
+        self.pending_commands = defaultdict(list)
+        self.ack_durations = []
+
+    def request_done(self, kind, status, duration):
+        with self.lock:
+            self.durations[kind].append(duration)
+            self.statuses[kind][status] += 1
+
+    def command_posted(self, receiver_id, posted_at, temperature):
+        with self.lock:
+            self.pending_commands[receiver_id].append((posted_at, temperature))
+
+    def command_acknowledged(self, sender, **kw):
+        """Matches ack to the oldest command posted with its temperature.
+
+        Commands posted before it count as done as well, they got replaced in the coalescing
+        command queue or overtaken by it.
+        """
+        msg = kw['msg']
+        if not isinstance(msg, SetTemperatureMessage):
+            return
+        now = time.time()
+        with self.lock:
+            pending = self.pending_commands[msg.receiver_id]
+            for index, (posted_at, temperature) in enumerate(pending):
+                if temperature == kw['payload']['desired_temperature']:
+                    self.ack_durations.extend(now - posted_at for posted_at, _ in pending[:index + 1])
+                    del pending[:index + 1]
+                    break
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError("unknown request kind %s, choose from %s" % (kind, ", ".join(REQUEST_KINDS)))
+        weights.append((kind, float(weight or 1)))
+    return weights
+
+
+def choose(weights):
+    target = random.uniform(0, sum(weight for _, weight in weights))
+    for kind, weight in weights:
+        target -= weight
+        if target <= 0:
+            break
+    return kind
+
+
+def client(base_url, deadline, args, sender_ids, results):
+    while time.time() < deadline:
+        kind = choose(args.mix)
+        data = None
+        if kind == "states":
+            url = base_url + "/current_thermostat_states"
+        elif kind == "columns":
+            url = base_url + "/current_thermostat_states?layout=columns"
+        elif kind == "history":
+            url = base_url + "/history/%i" % random.choice(sender_ids)
+        else:
+            url = base_url + "/set_temp"
+            receiver_id = random.choice(sender_ids)
+            form = {'thermostat': receiver_id, 'mode': 'manual', 'temperature': random.randint(34, 46) / 2.0}
+            if args.urgent:
+                form['urgent'] = 'on'
+            data = urllib.urlencode(form)
+        began = time.time()
+        try:
+            response = urllib2.urlopen(url, data, timeout=30)
+            response.read()
+            status = response.getcode()
+        except urllib2.HTTPError as e:
+            status = e.code
+        except (urllib2.URLError, IOError):
+            status = "error"
+        if kind == "set_temp" and status == 200:
+            results.command_posted(receiver_id, began, form['temperature'])
+        results.request_done(kind, status, time.time() - began)
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def sample_queues(radio, stop, samples, interval=0.5):
+    while not stop.wait(interval):
+        for name, queue in radio.statistics()['queues'].items():
+            samples[name].append(queue['size'])
+
+
+def main(args):
+    # the summary is what matters, not every request and radio event
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    logbook.StderrHandler(level="WARNING").push_application()
+    workdir = tempfile.mkdtemp()
+    try:
+        server = imp.load_source("moritz_server", SERVER_PATH)
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, "loadtest.db")
+        server.db.create_all()
+        sender_ids = range(FIRST_SENDER_ID, FIRST_SENDER_ID + args.thermostats)
+        for sender_id in sender_ids:
+            server.create_thermostat(sender_id, "SIM%07i" % (sender_id - FIRST_SENDER_ID), "1.0")
+            server.mark_thermostat_paired(sender_id)
+
+        cul = SimulatedCUL(sender_ids, report_interval=args.report_interval, ack_delay=args.ack_delay, ack_loss=args.ack_loss)
+        server_args = argparse.Namespace(
+            storage=args.storage, storage_path=os.path.join(workdir, "history"), command_queue_size=args.command_queue_size,
+            command_queue_policy=args.command_queue_policy, cul_path="simulated", state_snapshot=None, stall_timeout=900,
+            only_known_devices=False, rules=None, poll_interval=0, poll_min_age=1800, poll_min_budget=None)
+        server.radio = radio = server.start_radio(server_args, serial_factory=cul.open)
+        server.message_thread.start()
+        results = Results()
+        command_acknowledged.connect(results.command_acknowledged)
+
+        httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+        http_thread = threading.Thread(target=httpd.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+        base_url = "http://127.0.0.1:%i" % httpd.server_port
+        if not server.message_thread.com_thread.init_finished.wait(10):
+            print "Simulated CUL did not initialize"
+            return
+
+        stop_sampling = threading.Event()
+        queue_samples = defaultdict(list)
+        sampler = threading.Thread(target=sample_queues, args=(radio, stop_sampling, queue_samples))
+        sampler.start()
+        began = time.time()
+        deadline = began + args.duration
+        clients = [threading.Thread(target=client, args=(base_url, deadline, args, sender_ids, results))
+                   for _ in xrange(args.clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.time() - began
+        # commands may still be held until their thermostat reports next
+        time.sleep(args.drain)
+        stop_sampling.set()
+        sampler.join()
+        httpd.shutdown()
+        server.message_thread.join()
+
+        print "%i thermostats reporting every %is, %i clients for %.1fs" % (
+            args.thermostats, args.report_interval, args.clients, elapsed)
+        total = sum(len(durations) for durations in results.durations.values())
+        print "%-9s %6i requests %8.1f/s" % ("total", total, total / elapsed)
+        for kind in REQUEST_KINDS:
+            durations = results.durations.get(kind)
+            if durations:
+                statuses = ", ".join("%s: %i" % item for item in sorted(results.statuses[kind].items()))
+                print "%-9s %6i requests %8.1f/s %s (%s)" % (kind, len(durations), len(durations) / elapsed, percentiles(durations), statuses)
+        for name, sizes in sorted(queue_samples.items()):
+            if sizes:
+                print "queue %-9s start %4i end %4i max %4i mean %6.1f" % (name, sizes[0], sizes[-1], max(sizes), float(sum(sizes)) / len(sizes))
+        unacknowledged = sum(len(pending) for pending in results.pending_commands.values())
+        print "command to ack %6i acknowledged %s, %i unacknowledged" % (
+            len(results.ack_durations), percentiles(results.ack_durations), unacknowledged)
+        print "radio: %i commands sent, %i acks, %i state reports, %i budget overflows" % (
+            cul.commands_received, cul.acks_sent, cul.reports_sent, cul.overflows)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thermostats", type=int, default=50, help="Simulated thermostats, defaults to 50")
+    parser.add_argument("--report-interval", type=int, default=30, help="Seconds between state reports of each thermostat, defaults to 30")
+    parser.add_argument("--ack-delay", type=float, default=0.1, help="Seconds until a thermostat acknowledges a command, defaults to 0.1")
+    parser.add_argument("--ack-loss", type=float, default=0.0, help="Share of acknowledgements lost on air, defaults to 0")
+    parser.add_argument("--clients", type=int, default=10, help="Concurrent HTTP clients, defaults to 10")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send requests for, defaults to 30")
+    parser.add_argument("--drain", type=float, default=5, help="Seconds to wait for outstanding acks afterwards, defaults to 5")
+    parser.add_argument("--think-time", type=float, default=0, help="Seconds each client waits between requests, defaults to 0")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("states=6,history=2,set_temp=2"),
+                        help="Weighted request kinds out of %s, defaults to states=6,history=2,set_temp=2" % ", ".join(REQUEST_KINDS))
+    parser.add_argument("--urgent", action="store_true", help="Wake thermostats up for commands instead of waiting for their next report")
+    parser.add_argument("--command-queue-size", type=int, default=50, help="Command queue size of the server, defaults to 50")
+    parser.add_argument("--command-queue-policy", choices=OVERFLOW_POLICIES, default="coalesce", help="Command queue overflow policy of the server, defaults to coalesce")
+    parser.add_argument("--storage", choices=("sqlalchemy", "segments"), default="sqlalchemy", help="History backend, defaults to sqlalchemy")
+    args = parser.parse_args()
+    main(args)
@@ -12,22 +12,44 @@
 # environment constants
 
 # python imports
-from datetime import datetime
-import Queue
+import time
+startup_started = time.time()
+from datetime import datetime, timedelta
 import json
-from json import encoder
+import multiprocessing
+import os
+import signal
+import threading
+import zlib
 
 # environment imports
-from flask import Flask, request, url_for
+from flask import Flask, Response, request, url_for
 from flask.ext.sqlalchemy import SQLAlchemy
+import logbook
+try:
+    # considerably faster than json, but optional
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
 
 # custom imports
-from moritzprotocol.communication import CULMessageThread, CUBE_ID
-from moritzprotocol.messages import SetTemperatureMessage
+from moritzprotocol.communication import CULMessageThread, FrameFilter, CUBE_ID
+from moritzprotocol.exceptions import InvalidWeekProfileError, QueueFullError
+from moritzprotocol.ipc import RadioClient, RadioListener, SharedStateTable
+from moritzprotocol.messages import (
+    MODE_IDS, MODES_BY_NAME, MORITZ_MESSAGE_TYPES, AckMessage, PairPingMessage, SetTemperatureMessage, ThermostatStateMessage)
+from moritzprotocol.polling import StatePoller
+from moritzprotocol.queues import BoundedQueue, OVERFLOW_POLICIES
+from moritzprotocol.rules import RuleEngine, load_rules
+from moritzprotocol.stats import LatencyStatistics
+from moritzprotocol.storage import StateStorage, SegmentStorage
 from moritzprotocol.signals import device_pair_accepted, device_pair_request, thermostatstate_received
 
-# local constantsfrom datetime import datetime
-encoder.FLOAT_REPR = lambda o: format(o, '.2f')
+# local constants
+imports_finished = time.time()
+server_logger = logbook.Logger("MoritzServer")
+# responses of at least this size get compressed if the client accepts gzip
+GZIP_MIN_SIZE = 1024
 
 #
 # Environment Setup
@@ -39,11 +61,28 @@ class JSONWithDateEncoder(json.JSONEncoder):
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
 
+def render_json(obj, status=200):
+    """Returns compact JSON response of obj, pretty printed if ?pretty is given.
+
+    Datetimes should be rendered to ISO strings before, only the stdlib encoder handles them.
+    """
+    if 'pretty' in request.args:
+        body = json.dumps(obj, indent=4, sort_keys=True, cls=JSONWithDateEncoder)
+    elif fast_json is not None:
+        body = fast_json.dumps(obj)
+    else:
+        body = json.dumps(obj, separators=(',', ':'), cls=JSONWithDateEncoder)
+    return Response(body, status, mimetype="application/json")
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///moritz-server.db'
 db = SQLAlchemy(app)
 
-command_queue = Queue.Queue()
+# replaced in main() according to command line options
+command_queue = BoundedQueue(50, "coalesce")
+# pair responses are sent by the radio thread, the database is updated by registry_worker afterwards
+registry_queue = BoundedQueue(100, "reject")
+registry_latency = LatencyStatistics()
 
 #
 # Models
@@ -85,57 +124,276 @@ class ThermostatState(db.Model):
 #
 # Signal responders
 #
-@device_pair_request.connect
-def create_new_thermostat(sender, **kw):
-    msg = kw['msg']
-    entry = Thermostat.query.filter_by(sender_id=msg.sender_id).first()
+def create_thermostat(sender_id, serial, firmware_version):
+    entry = Thermostat.query.filter_by(sender_id=sender_id).first()
     if entry is None:
-        entry = Thermostat(msg.sender_id, msg.decoded_payload['device_serial'])
-        entry.firmware_version = msg.decoded_payload['firmware_version']
+        entry = Thermostat(sender_id, serial)
+        entry.firmware_version = firmware_version
         db.session.add(entry)
         db.session.commit()
 
-@device_pair_accepted.connect
-def activate_thermostat(sender, **kw):
-    msg = kw['resp_msg']
-    entry = Thermostat.query.filter_by(sender_id=msg.receiver_id).first()
+def mark_thermostat_paired(sender_id):
+    entry = Thermostat.query.filter_by(sender_id=sender_id).first()
     if entry is None:
-        entry = Thermostat(msg.receiver_id, "Unknown")
+        entry = Thermostat(sender_id, "Unknown")
     entry.paired = True
     db.session.add(entry)
     db.session.commit()
 
+def queue_registry_update(func, *args):
+    try:
+        registry_queue.put((func, args, time.time()))
+    except QueueFullError:
+        server_logger.error("Registry update queue full, dropping %s%r" % (func.__name__, args))
+
+def registry_worker():
+    """Applies queued registry updates, keeping database latency out of the radio thread"""
+    while True:
+        func, args, queued_at = registry_queue.get()
+        try:
+            func(*args)
+        except Exception:
+            # any failure would end this thread and leave the queue filling up unnoticed
+            db.session.rollback()
+            server_logger.exception("Registry update %s%r failed" % (func.__name__, args))
+        registry_latency.add(time.time() - queued_at)
+
+@device_pair_request.connect
+def create_new_thermostat(sender, **kw):
+    msg = kw['msg']
+    queue_registry_update(create_thermostat, msg.sender_id, msg.decoded_payload['device_serial'],
+                          msg.decoded_payload['firmware_version'])
+
+@device_pair_accepted.connect
+def activate_thermostat(sender, **kw):
+    queue_registry_update(mark_thermostat_paired, kw['resp_msg'].receiver_id)
+
 @thermostatstate_received.connect
 def store_thermostatstate(sender, **kw):
     msg = kw['msg']
-    thermostat = Thermostat.query.filter_by(sender_id=msg.sender_id).first()
-    if thermostat is None:
-        return
-    thermostat_state = ThermostatState()
-    thermostat_state.thermostat = thermostat
-    decoded_payload = msg.decoded_payload
-    for parameter in ["last_updated", "rferror", "signal_strength", "desired_temperature",
-                      "is_locked", "valve_position", "lan_gateway", "dstsetting", "mode",
-                      "measured_temperature", "battery_low",]:
-        if parameter in decoded_payload:
-            setattr(thermostat_state, parameter, decoded_payload[parameter])
-    db.session.add(thermostat_state)
-    db.session.commit()
+    with sender.thermostat_states_lock:
+        state = dict(sender.thermostat_states[msg.sender_id])
+    storage.store_state(msg.sender_id, state['last_updated'], state, kw['changes'])
+
+#
+# Storage backends
+#
+class SQLAlchemyStorage(StateStorage):
+    """Stores changed values as ThermostatState rows of known thermostats"""
+
+    columns = ["rferror", "signal_strength", "desired_temperature", "is_locked", "valve_position",
+               "lan_gateway", "dstsetting", "mode", "measured_temperature", "battery_low"]
+
+    def store_state(self, sender_id, timestamp, state, changes):
+        thermostat = Thermostat.query.filter_by(sender_id=sender_id).first()
+        if thermostat is None:
+            return
+        thermostat_state = ThermostatState()
+        thermostat_state.thermostat = thermostat
+        thermostat_state.last_updated = timestamp
+        # only changed values are stored, unchanged ones stay NULL
+        for parameter in self.columns:
+            if parameter in changes:
+                setattr(thermostat_state, parameter, changes[parameter])
+        if 'mode' in changes:
+            # mode column is an Integer holding MODE_IDS
+            thermostat_state.mode = MODES_BY_NAME.get(changes['mode'])
+        db.session.add(thermostat_state)
+        db.session.commit()
+
+    def query_states(self, sender_id, start, end):
+        states = []
+        query = ThermostatState.query.join(Thermostat).filter(
+            Thermostat.sender_id == sender_id,
+            ThermostatState.last_updated >= start,
+            ThermostatState.last_updated <= end,
+        ).order_by(ThermostatState.last_updated)
+        for thermostat_state in query:
+            state = {'last_updated': thermostat_state.last_updated}
+            for parameter in self.columns:
+                value = getattr(thermostat_state, parameter)
+                if value is not None:
+                    state[parameter] = value
+            # rows stored before hold the mode name itself
+            if isinstance(state.get('mode'), (int, long)):
+                state['mode'] = MODE_IDS.get(state['mode'])
+            states.append(state)
+        return states
+
+# replaced in main() according to command line options
+storage = SQLAlchemyStorage()
+
+#
+# Radio engine access
+#
+class LocalRadio(object):
+    """Everything the views need from the radio engine running in this process"""
+
+    # methods callable by web processes if the radio runs in its own process
+    exported = ("put_command", "put_commands", "next_counter", "saturated", "statistics", "link_quality",
+                "week_profiles", "set_week_profile", "query_states")
+
+    def __init__(self, message_thread, command_queue, rule_engine=None):
+        self.message_thread = message_thread
+        self.command_queue = command_queue
+        self.rule_engine = rule_engine
+
+    def states(self):
+        with self.message_thread.thermostat_states_lock:
+            return self.message_thread.thermostat_states.as_dict(iso_dates=True)
+
+    def state_columns(self):
+        with self.message_thread.thermostat_states_lock:
+            return self.message_thread.thermostat_states.as_columns()
+
+    def put_command(self, command):
+        self.command_queue.put(command)
+
+    def put_commands(self, commands):
+        """Queues all commands or, raising QueueFullError, none of them"""
+        self.command_queue.put_all(commands)
+
+    def next_counter(self):
+        return self.message_thread.next_counter()
+
+    def saturated(self):
+        return self.command_queue.full() or self.message_thread.com_send_queue.full()
+
+    def statistics(self):
+        message_thread = self.message_thread
+        duplicate_filter = message_thread.duplicate_filter
+        result = {
+            'duplicate_frames': {
+                'lookups': duplicate_filter.lookups,
+                'hits': duplicate_filter.hits,
+                'hit_rate': round(duplicate_filter.hit_rate, 3),
+            },
+            'unhandled_messages': message_thread.unhandled_messages,
+            'transport': {
+                'connected': message_thread.com_thread.connected.isSet(),
+                'reconnects': message_thread.com_thread.reconnects,
+                'cul_version': message_thread.com_thread.cul_version,
+            },
+            'pairing': {
+                'response_latency': message_thread.pair_response_latency.as_dict(),
+                'registry_latency': registry_latency.as_dict(),
+            },
+            'queues': {
+                'command': self.command_queue.statistics(),
+                'registry': registry_queue.statistics(),
+                'send': message_thread.com_send_queue.statistics(),
+                'receive': message_thread.com_receive_queue.statistics(),
+            },
+        }
+        if self.rule_engine is not None:
+            result['rules'] = self.rule_engine.statistics()
+        if message_thread.poller is not None:
+            result['poller'] = message_thread.poller.statistics()
+        if message_thread.frame_filter is not None:
+            result['frame_filter'] = {
+                'accepted': message_thread.frame_filter.accepted,
+                'filtered': dict(message_thread.frame_filter.filtered),
+            }
+        return result
+
+    def link_quality(self):
+        return dict((sender_id, link.as_dict()) for sender_id, link in self.message_thread.link_quality.items())
+
+    def week_profiles(self):
+        profiles = {}
+        for sender_id, parts in self.message_thread.week_profiles.items():
+            profiles[sender_id] = dict(("%s/%i" % day_part, entries) for day_part, entries in parts.items())
+        return profiles
+
+    def set_week_profile(self, receiver_id, profile):
+        return self.message_thread.set_week_profile(receiver_id, profile)
+
+    def query_states(self, sender_id, start, end):
+        return storage.query_states(sender_id, start, end)
+
+
+class RemoteRadio(RadioClient):
+    """LocalRadio of the radio process, states are read from shared memory without asking it"""
+
+    def __init__(self, address, authkey, state_table):
+        RadioClient.__init__(self, address, authkey)
+        self.state_table = state_table
+
+    def states(self):
+        return self.state_table.as_dict(iso_dates=True)
+
+    def state_columns(self):
+        return self.state_table.as_columns()
+
+# set up in main(), either LocalRadio or RemoteRadio
+radio = None
 
 #
 # Views
 #
+@app.after_request
+def report_saturation(response):
+    if radio.saturated():
+        response.headers['X-Outbound-Saturated'] = '1'
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    # level 5 compresses JSON nearly as well as 9 at a fraction of the time
+    compressor = zlib.compressobj(5, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.errorhandler(QueueFullError)
+def outbound_saturated(error):
+    return "Outbound command queue saturated, try again later", 503, {'Retry-After': '10'}
+
 @app.route("/")
 def index():
     return "<a href='" + url_for("get_devices") + "'>Tracked devices</a><br>" + \
            "<a href='" + url_for("current_thermostat_states") + "'>Current states</a><br>" + \
            "<a href='" + url_for("set_temp") + "'>Set one temp</a><br>" + \
-           "<a href='" + url_for("set_temp_all") + "'>Set temp on all sensors</a>"
+           "<a href='" + url_for("set_temp_all") + "'>Set temp on all sensors</a><br>" + \
+           "<a href='" + url_for("week_profile") + "'>Confirmed week profiles</a><br>" + \
+           "<a href='" + url_for("link_quality") + "'>Link quality</a><br>" + \
+           "<a href='" + url_for("statistics") + "'>Statistics</a>"
 
 @app.route("/current_thermostat_states")
 def current_thermostat_states():
-    with message_thread.thermostat_states_lock:
-        return json.dumps(message_thread.thermostat_states, indent=4, sort_keys=True, cls=JSONWithDateEncoder)
+    """?layout=columns returns one list per field instead of a dict per device, much cheaper for many devices"""
+    if request.args.get('layout') == "columns":
+        return render_json(radio.state_columns())
+    return render_json(radio.states())
+
+@app.route("/statistics")
+def statistics():
+    return render_json(radio.statistics())
+
+@app.route("/link_quality")
+def link_quality():
+    return render_json(radio.link_quality())
+
+@app.route("/history/<int:sender_id>")
+def history(sender_id):
+    """States of the last 24h or between ISO formatted start and end query parameters"""
+    try:
+        end = datetime.strptime(request.args['end'], "%Y-%m-%dT%H:%M:%S") if 'end' in request.args else datetime.now()
+        start = datetime.strptime(request.args['start'], "%Y-%m-%dT%H:%M:%S") if 'start' in request.args else end - timedelta(days=1)
+    except ValueError as e:
+        return render_json({'error': str(e)}, 400)
+    states = radio.query_states(sender_id, start, end)
+    for state in states:
+        state['last_updated'] = state['last_updated'].isoformat()
+    return render_json(states)
 
 @app.route("/get_devices")
 def get_devices():
@@ -148,7 +406,7 @@ def get_devices():
             'name': thermostat.name,
             'paired': thermostat.paired,
         })
-    return json.dumps(devices)
+    return render_json(devices)
 
 @app.route("/set_temp", methods=["GET", "POST"])
 def set_temp():
@@ -157,10 +415,11 @@ def set_temp():
         for thermostat in Thermostat.query.filter_by(paired=True):
             content += """<option value="%s">%s</option>""" % (thermostat.sender_id, thermostat.name)
         content += """</select><select name="mode"><option>auto</option><option selected>manual</option><option>boost</option></select>"""
-        content += """<input type=text name=temperature><input type=submit value="set"></form></html>"""
+        content += """<input type=text name=temperature><label><input type=checkbox name=urgent>wake up now</label>"""
+        content += """<input type=submit value="set"></form></html>"""
         return content
     msg = SetTemperatureMessage()
-    msg.counter = 0xB9
+    msg.counter = radio.next_counter()
     msg.sender_id = CUBE_ID
     msg.receiver_id = int(request.form['thermostat'])
     msg.group_id = 0
@@ -168,7 +427,8 @@ def set_temp():
         'desired_temperature': float(request.form["temperature"]),
         'mode': request.form["mode"],
     }
-    command_queue.put((msg, payload))
+    # urgent commands wake the thermostat up instead of waiting for it to transmit
+    radio.put_command((msg, payload, 'urgent' in request.form))
     return """<html>Done. <a href="/">back</a>"""
 
 @app.route("/set_temp_all", methods=["GET", "POST"])
@@ -177,9 +437,10 @@ def set_temp_all():
         content = """<html><form action="" method="POST"><select name="mode"><option>auto</option><option selected>manual</option><option>boost</option></select>"""
         content += """<input type=text name=temperature><input type=submit value="set"></form></html>"""
         return content
+    commands = []
     for thermostat in Thermostat.query.filter_by(paired=True):
         msg = SetTemperatureMessage()
-        msg.counter = 0xB9
+        msg.counter = radio.next_counter()
         msg.sender_id = CUBE_ID
         msg.receiver_id = thermostat.sender_id
         msg.group_id = 0
@@ -187,23 +448,129 @@ def set_temp_all():
             'desired_temperature': float(request.form["temperature"]),
             'mode': request.form["mode"],
         }
-        command_queue.put((msg, payload))
+        commands.append((msg, payload))
+    # all or none, so a client retrying after 503 does not get a partly applied change
+    radio.put_commands(commands)
     return """<html>Done. <a href="/">back</a>"""
 
+@app.route("/week_profile", methods=["GET", "POST"])
+def week_profile():
+    """GET lists confirmed week profiles, POST expects JSON like
+    {"thermostat": 123, "profile": {"monday": [["06:00", 17], ["22:00", 21], ["24:00", 17]]}}"""
+    if request.method == "GET":
+        return render_json(radio.week_profiles())
+    data = request.get_json(force=True)
+    try:
+        queued = radio.set_week_profile(int(data['thermostat']), data['profile'])
+    except (InvalidWeekProfileError, KeyError, ValueError) as e:
+        return render_json({'error': str(e)}, 400)
+    return render_json({'queued_messages': queued})
+
 #
 # Execution
 #
-def main(args):
-    global message_thread
-    message_thread = CULMessageThread(command_queue, args.cul_path)
+def report_startup_timing(db_duration):
+    """Logs where startup time went once the CUL is initialized"""
+    com_thread = message_thread.com_thread
+    com_thread.init_finished.wait(60)
+    server_logger.info("startup: imports %.2fs, database %.2fs, CUL init %s in parallel, total %.2fs" % (
+        imports_finished - startup_started, db_duration,
+        "%.2fs" % com_thread.init_duration if com_thread.init_duration is not None else "failed",
+        time.time() - startup_started))
+
+def start_radio(args, serial_factory=None):
+    """Starts radio engine of this process and returns LocalRadio for it.
+
+    serial_factory replaces the serial port of the CUL, e.g. by a simulated one.
+    """
+    global message_thread, command_queue, storage
+    if args.storage == "segments":
+        storage = SegmentStorage(args.storage_path)
+    command_queue = BoundedQueue(args.command_queue_size, args.command_queue_policy)
+    message_thread = CULMessageThread(command_queue, args.cul_path, state_snapshot_path=args.state_snapshot,
+                                      stall_timeout=args.stall_timeout, serial_factory=serial_factory)
+    # CUL initialization takes a while, so prepare the database meanwhile
+    message_thread.com_thread.start()
+    db_started = time.time()
+    db.create_all()
+    db_duration = time.time() - db_started
+    if args.only_known_devices:
+        # frames not from or to us or our paired devices are dropped before decoding
+        message_thread.frame_filter = FrameFilter(
+            receiver_ranges=[(CUBE_ID, CUBE_ID)],
+            known_devices=[thermostat.sender_id for thermostat in Thermostat.query.filter_by(paired=True)],
+            always_accepted_types=[MORITZ_MESSAGE_TYPES[PairPingMessage]])
+    if args.poll_interval:
+        # stale states get refreshed with send budget left over by commands
+        message_thread.poller = StatePoller(message_thread, args.poll_interval, args.poll_min_age, args.poll_min_budget)
+    # rules queue their commands directly, no need to poll the HTTP API for automation
+    rule_engine = RuleEngine(message_thread, load_rules(args.rules)) if args.rules else None
+    registry_thread = threading.Thread(target=registry_worker)
+    registry_thread.daemon = True
+    registry_thread.start()
+
+    timing_thread = threading.Thread(target=report_startup_timing, args=(db_duration,))
+    timing_thread.daemon = True
+    timing_thread.start()
+    return LocalRadio(message_thread, command_queue, rule_engine)
+
+def radio_main(args, authkey, state_table, ready):
+    """Entry point of the radio process, serving web processes until terminated"""
+    local_radio = start_radio(args)
+
+    def publish_state(msg, signal_strength):
+        with message_thread.thermostat_states_lock:
+            state = message_thread.thermostat_states.get(msg.sender_id)
+            if state is not None:
+                state_table.publish(msg.sender_id, state)
+    # registered after the built-in handlers, so states are already updated when called
+    message_thread.register_message_handler(ThermostatStateMessage, publish_state)
+    message_thread.register_message_handler(AckMessage, publish_state)
+    with message_thread.thermostat_states_lock:
+        for sender_id, state in message_thread.thermostat_states.items():
+            state_table.publish(sender_id, state)
+
+    # terminated by the web process on exit, shut down cleanly to save the state snapshot
+    terminate_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminate_requested.set())
+    listener = RadioListener(args.radio_socket, authkey, local_radio, LocalRadio.exported)
+    listener.start()
     message_thread.start()
+    ready.set()
+    while not terminate_requested.isSet():
+        # waiting in steps, as waiting without timeout is not interrupted by signals
+        terminate_requested.wait(1)
+    listener.close()
+    message_thread.join()
+    storage.close()
+
+def main(args):
+    global radio
+    if args.radio_process:
+        authkey = os.urandom(16)
+        # created before forking, so web processes never see a missing table
+        state_table = SharedStateTable(args.shared_state, writer=True)
+        ready = multiprocessing.Event()
+        radio_process = multiprocessing.Process(target=radio_main, args=(args, authkey, state_table, ready))
+        radio_process.daemon = True
+        radio_process.start()
+        if not ready.wait(60):
+            server_logger.error("Radio process did not start within 60s")
+            return
+        radio = RemoteRadio(args.radio_socket, authkey, SharedStateTable(args.shared_state))
+    else:
+        radio = start_radio(args)
+        message_thread.start()
 
     if args.flask_debug:
         app.run(host="0.0.0.0", port=12345, debug=True, use_reloader=False)
     else:
-        app.run(host="0.0.0.0", port=12345)
+        # separate web processes only share what the radio process publishes
+        app.run(host="0.0.0.0", port=12345, processes=args.web_processes)
 
-    message_thread.join()
+    if not args.radio_process:
+        message_thread.join()
+        storage.close()
 
 if __name__ == '__main__':
     import argparse
@@ -211,9 +578,27 @@ if __name__ == '__main__':
     parser.add_argument("--flask-debug", action="store_true", help="Enables Flask debug and reload. May cause weird behaviour.")
     parser.add_argument("--detach", action="store_true", help="Detach from terminal")
     parser.add_argument("--cul-path", default="/dev/ttyACM0", help="Path to usbmodem path of CUL, defaults to /dev/ttyACM0")
+    parser.add_argument("--state-snapshot", default="moritz-state.json", help="File to checkpoint current thermostat states to, restored on start")
+    parser.add_argument("--only-known-devices", action="store_true", help="Ignore traffic of devices not paired with us, except pair requests")
+    parser.add_argument("--command-queue-size", type=int, default=50, help="Maximum of pending commands, defaults to 50")
+    parser.add_argument("--command-queue-policy", choices=OVERFLOW_POLICIES, default="coalesce",
+                        help="What to do with new commands if queue is full. coalesce replaces pending commands to the same device. Defaults to coalesce")
+    parser.add_argument("--stall-timeout", type=int, default=900, help="Seconds without anything received before checking whether CUL still responds, defaults to 900")
+    parser.add_argument("--storage", choices=("sqlalchemy", "segments"), default="sqlalchemy",
+                        help="Backend for state history, either database rows or append-only segment files. Defaults to sqlalchemy")
+    parser.add_argument("--storage-path", default="moritz-history", help="Directory of segment storage, defaults to moritz-history")
+    parser.add_argument("--rules", help="JSON file of automation rules, see moritzprotocol.rules")
+    parser.add_argument("--poll-interval", type=int, default=0,
+                        help="Seconds between status requests to thermostats with stale state, only sent with surplus send budget. Defaults to 0, disabled")
+    parser.add_argument("--poll-min-age", type=int, default=1800, help="Seconds after which a state counts as stale, defaults to 1800")
+    parser.add_argument("--poll-min-budget", type=int, help="Send budget in ms required for polling, defaults to the budget required for weak links")
+    parser.add_argument("--radio-process", action="store_true", help="Run radio handling in its own process, so HTTP requests cannot delay it")
+    parser.add_argument("--web-processes", type=int, default=1, help="Amount of processes serving HTTP, more than one requires --radio-process")
+    parser.add_argument("--radio-socket", default="moritz-radio.sock", help="Socket web processes send commands to the radio process on, defaults to moritz-radio.sock")
+    parser.add_argument("--shared-state", default="moritz-state.shm", help="File the radio process publishes states to, best placed in /dev/shm. Defaults to moritz-state.shm")
     args = parser.parse_args()
-
-    db.create_all()
+    if args.web_processes > 1 and not args.radio_process:
+        parser.error("--web-processes requires --radio-process")
 
     if args.detach:
 
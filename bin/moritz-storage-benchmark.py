@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    moritz-storage-benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares insert rate and range query latency of the state history backends of moritz-server
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from datetime import datetime, timedelta
+import imp
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# environment imports
+
+# custom imports
+from moritzprotocol.storage import SegmentStorage
+
+# local constants
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "moritz-server.py")
+
+
+def generate_states(sender_ids, count, started):
+    """Returns list of (sender_id, timestamp, state, changes) as produced by a running server"""
+
+    states = []
+    for index in xrange(count):
+        state = {
+            'mode': 'auto',
+            'desired_temperature': random.choice((17.0, 19.5, 21.0)),
+            'measured_temperature': round(random.uniform(15, 25), 1),
+            'valve_position': random.randint(0, 100),
+            'dstsetting': True,
+            'langateway': True,
+            'is_locked': False,
+            'rferror': False,
+            'battery_low': False,
+            'signal_strenth': random.randint(0, 255),
+        }
+        changes = {'measured_temperature': state['measured_temperature'], 'valve_position': state['valve_position']}
+        states.append((sender_ids[index % len(sender_ids)], started + timedelta(seconds=index), state, changes))
+    return states
+
+
+def benchmark(name, storage, states, sender_ids, started, queries):
+    began = time.time()
+    for sender_id, timestamp, state, changes in states:
+        storage.store_state(sender_id, timestamp, state, changes)
+    insert_duration = time.time() - began
+
+    span = (states[-1][1] - started).total_seconds()
+    durations = []
+    found = 0
+    for _ in xrange(queries):
+        start = started + timedelta(seconds=random.uniform(0, span))
+        began = time.time()
+        found += len(storage.query_states(random.choice(sender_ids), start, start + timedelta(hours=1)))
+        durations.append(time.time() - began)
+    durations.sort()
+    print "%-10s %8.0f inserts/s, range query median %.2fms p95 %.2fms (%i states found)" % (
+        name, len(states) / insert_duration, durations[len(durations) / 2] * 1000,
+        durations[int(len(durations) * 0.95)] * 1000, found)
+
+
+def main(args):
+    random.seed(0)
+    sender_ids = range(0x100000, 0x100000 + args.devices)
+    started = datetime(2014, 12, 1)
+    states = generate_states(sender_ids, args.states, started)
+    workdir = tempfile.mkdtemp()
+    try:
+        server = imp.load_source("moritz_server", SERVER_PATH)
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, "benchmark.db")
+        server.db.create_all()
+        for sender_id in sender_ids:
+            server.db.session.add(server.Thermostat(sender_id, "BENCH%06X" % sender_id))
+        server.db.session.commit()
+        benchmark("sqlalchemy", server.SQLAlchemyStorage(), states, sender_ids, started, args.queries)
+
+        storage = SegmentStorage(os.path.join(workdir, "segments"))
+        benchmark("segments", storage, states, sender_ids, started, args.queries)
+        storage.close()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=10, help="Number of simulated thermostats")
+    parser.add_argument("--states", type=int, default=5000, help="Number of states to insert per backend")
+    parser.add_argument("--queries", type=int, default=200, help="Number of one hour range queries per backend")
+    args = parser.parse_args()
+    main(args)
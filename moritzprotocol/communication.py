@@ -16,25 +16,33 @@
 # environment constants
 
 # python imports
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
+import itertools
+import os
 import Queue
 import threading
 import time
 
 # environment imports
 import logbook
-from serial import Serial
 
 # custom imports
-from moritzprotocol.exceptions import MoritzError
+from moritzprotocol.exceptions import MoritzError, QueueFullError, UnknownMessageError
 from moritzprotocol.messages import (
-    MoritzMessage, MoritzError,
+    MoritzMessage, MORITZ_MESSAGE_IDS, MORITZ_MESSAGE_TYPES,
     PairPingMessage, PairPongMessage,
-    TimeInformationMessage,
+    TimeInformationMessage, ConfigWeekProfileMessage, WakeUpMessage,
     SetTemperatureMessage, ThermostatStateMessage, AckMessage
 )
-from moritzprotocol.signals import thermostatstate_received, device_pair_accepted, device_pair_request
+from moritzprotocol.signals import (
+    thermostatstate_received, device_pair_accepted, device_pair_request, command_acknowledged
+)
+from moritzprotocol.linkquality import LinkQuality
+from moritzprotocol.queues import BoundedQueue, command_coalesce_key
+from moritzprotocol.stats import LatencyStatistics
+from moritzprotocol.states import ThermostatStates
+from moritzprotocol.weekprofile import changed_parts
 
 # local constants
 com_logger = logbook.Logger("CUL Serial")
@@ -45,31 +53,96 @@ CUBE_ID = 0x123456
 WALLTHERMO_ID = 0x123457
 SHUTTERCONTACT_ID = 0x123458
 
+# Seconds to wait for an ack of a sent command before retrying it
+ACK_TIMEOUT = 10
+# Retries of unacknowledged commands before giving up
+MAX_RETRIES = 2
+# Seconds a battery powered device keeps listening after it transmitted
+AWAKE_WINDOW = 2
+# Seconds after which deferred commands are sent regardless of link or budget
+MAX_DEFER = 120
+# Seconds commands are held for a sleeping device before waking it up explicitly
+WAKEUP_AFTER = 180
+WAKEUP_DURATION = 0x3F
+# Commands held per sleeping device, the oldest one is dropped beyond that
+MAX_HELD_PER_DEVICE = 20
+# Send budget in ms above which sending to weak links is acceptable
+COMFORTABLE_SEND_BUDGET = 10000
+
 class CULComThread(threading.Thread):
-    """Low-level serial communication thread base"""
+    """Low-level serial communication thread base.
+
+    The serial transport is supervised: if the port fails or the CUL stalls (no reply to a
+    budget request within budget_timeout seconds, which is also requested after nothing got
+    received for stall_timeout seconds) the port is reopened with increasing backoff and the CUL initialized again. Queued and
+    pre-fetched outgoing messages are kept and sent once the CUL is back.
+    """
 
-    def __init__(self, send_queue, read_queue, device_path):
+    def __init__(self, send_queue, read_queue, device_path, stall_timeout=900, budget_timeout=10,
+                 max_backoff=60, serial_factory=None):
         super(CULComThread, self).__init__()
         self.send_queue = send_queue
         self.read_queue = read_queue
         self.device_path = device_path
+        self.stall_timeout = stall_timeout
+        self.budget_timeout = budget_timeout
+        self.max_backoff = max_backoff
+        self.serial_factory = serial_factory
+        self.com_port = None
         self.pending_line = []
         self.stop_requested = threading.Event()
+        self.connected = threading.Event()
+        self.reconnects = 0
         self.cul_version = ""
+        self.init_finished = threading.Event()
+        self.init_duration = None
+        # last budget reported by CUL, unlike _pending_budget not reset when sending
+        self.send_budget = 0
         self._pending_budget = 0
         self._pending_message = None
+        self._budget_requested_at = None
+        self._last_received = time.time()
 
     def run(self):
-        self._init_cul()
+        backoff = 1
+        while not self.stop_requested.isSet():
+            try:
+                if self._init_cul():
+                    backoff = 1
+                    self._communicate()
+            except (IOError, OSError) as e:
+                # pyserial's SerialException is an IOError as well
+                com_logger.error("Serial communication with CUL failed. Reason: %s" % str(e))
+            self._close_port()
+            if self.stop_requested.isSet():
+                break
+            self.reconnects += 1
+            com_logger.info("Reconnecting to CUL in %is" % backoff)
+            self.stop_requested.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _communicate(self):
+        """Exchanges messages with CUL until stop is requested or the CUL stalls"""
+
+        self.connected.set()
+        self._budget_requested_at = None
+        self._last_received = time.time()
         while not self.stop_requested.isSet():
             # Send budget request if we don't know it
             if self._pending_budget == 0:
+                if self._budget_requested_at is None:
+                    self._budget_requested_at = time.time()
+                elif time.time() - self._budget_requested_at > self.budget_timeout:
+                    com_logger.error("CUL did not report send budget for %is, assuming it stalled" % self.budget_timeout)
+                    return
                 self.send_command("X")
                 for i in range(10):
                     read_line = self._read_result()
                     if read_line is not None:
                         if read_line.startswith("21  "):
                             self._pending_budget = int(read_line[3:].strip()) * 10 or 1
+                            self.send_budget = self._pending_budget
+                            self._budget_requested_at = None
                             com_logger.info("Got pending budget message: %sms" % self._pending_budget)
                         else:
                             com_logger.info("Got unhandled response from CUL: '%s'" % read_line)
@@ -83,10 +156,17 @@ class CULComThread(threading.Thread):
             if read_line is not None:
                 if read_line.startswith("21  "):
                     self._pending_budget = int(read_line[3:].strip()) * 10 or 1
+                    self.send_budget = self._pending_budget
+                    self._budget_requested_at = None
                     com_logger.info("Got pending budget: %sms" % self._pending_budget)
                 else:
                     com_logger.info("Got unhandled response from CUL: '%s'" % read_line)
 
+            if self.stall_timeout and self._pending_budget and time.time() - self._last_received > self.stall_timeout:
+                # quiet for long, make sure CUL is still alive by requiring a budget reply
+                com_logger.info("Nothing received from CUL for %is, probing it" % self.stall_timeout)
+                self._pending_budget = 0
+
             if self._pending_message is None and not self.send_queue.empty():
                 com_logger.debug("Fetching message from queue")
                 self._pending_message = self.send_queue.get(True, 0.05)
@@ -111,47 +191,74 @@ class CULComThread(threading.Thread):
         self.stop_requested.set()
         super(CULComThread, self).join(timeout)
 
-    def _init_cul(self):
-        """Ensure CUL reports reception strength and does not do FS messages"""
+    def _open_port(self):
+        if self.serial_factory is None:
+            # imported here as pyserial takes noticeable time to load on small devices
+            from serial import Serial
+            self.serial_factory = Serial
+        self.pending_line = []
+        self.com_port = self.serial_factory(self.device_path)
+
+    def _close_port(self):
+        self.connected.clear()
+        self._pending_budget = 0
+        if self.com_port is not None:
+            try:
+                self.com_port.close()
+            except (IOError, OSError):
+                pass
+            self.com_port = None
 
-        self.com_port = Serial(self.device_path)
-        self._read_result()
-        # get CUL FW version
-        def _get_cul_ver():
+    def _init_cul(self):
+        """Ensure CUL reports reception strength and does not do FS messages. Returns whether CUL responded"""
+
+        started = time.time()
+        try:
+            self._open_port()
+            self._read_result()
+            # get CUL FW version
+            self.cul_version = self._request_version()
+            if not self.cul_version:
+                com_logger.info("No version from CUL reported. Closing and re-opening port")
+                self._close_port()
+                self._open_port()
+                self.cul_version = self._request_version()
+            if not self.cul_version:
+                com_logger.error("No version from CUL, cannot communicate")
+                return False
+            com_logger.info("CUL reported version %s" % self.cul_version)
+
+            # enable reporting of message strength
+            self.send_command("X21")
+            # receive Moritz messages
+            self.send_command("Zr")
+            # disable FHT mode by setting station to 0000
+            self.send_command("T01")
+            # CUL processes commands in order, so another version reply confirms the ones above
+            if not self._request_version(attempts=1, timeout=1.0):
+                com_logger.warning("CUL did not confirm initialization commands")
+            self.init_duration = time.time() - started
+            com_logger.info("CUL initialized in %.2fs" % self.init_duration)
+            return True
+        finally:
+            self.init_finished.set()
+
+    def _request_version(self, attempts=10, timeout=0.3):
+        """Asks CUL for its version, returns as soon as it is reported or empty string after all attempts"""
+
+        for i in range(attempts):
             self.send_command("V")
-            time.sleep(0.3)
-            self.cul_version = self._read_result() or ""
-        for i in range(10):
-            _get_cul_ver()
-            if self.cul_version:
-                com_logger.info("CUL reported version %s" % self.cul_version)
-                break
-            else:
-                com_logger.info("No version from CUL reported?")
-        if not self.cul_version:
-            com_logger.info("No version from CUL reported. Closing and re-opening port")
-            self.com_port.close()
-            self.com_port = Serial(self.device_path)
-            for i in range(10):
-                _get_cul_ver()
-                if self.cul_version:
-                    com_logger.info("CUL reported version %s" % self.cul_version)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                read_line = self._read_result()
+                if read_line is None:
+                    time.sleep(0.01)
+                elif read_line.startswith("V"):
+                    return read_line
                 else:
-                    com_logger.info("No version from CUL reported?")
-            com_logger.error("No version from CUL, cannot communicate")
-            self.stop_requested.set()
-            return
-
-        # enable reporting of message strength
-        self.send_command("X21")
-        time.sleep(0.3)
-        # receive Moritz messages
-        self.send_command("Zr")
-        time.sleep(0.3)
-        # disable FHT mode by setting station to 0000
-        self.send_command("T01")
-        time.sleep(0.3)
-        self._read_result()
+                    com_logger.info("Got unhandled response from CUL: '%s'" % read_line)
+            com_logger.info("No version from CUL reported?")
+        return ""
 
     @property
     def has_send_budget(self):
@@ -159,6 +266,12 @@ class CULComThread(threading.Thread):
 
         return self._pending_budget >= 2000
 
+    @property
+    def has_comfortable_budget(self):
+        """Whether the last reported budget leaves room for transmissions which might be wasted"""
+
+        return self.send_budget >= COMFORTABLE_SEND_BUDGET
+
     def send_command(self, command):
         """Sends given command to CUL. Invalidates has_send_budget if command starts with Zs"""
 
@@ -173,6 +286,7 @@ class CULComThread(threading.Thread):
         while self.com_port.inWaiting():
             self.pending_line.append(self.com_port.read(1))
             if self.pending_line[-1] == "\n":
+                self._last_received = time.time()
                 # remove newlines at the end
                 completed_line = "".join(self.pending_line[:-2])
                 com_logger.debug("received: %s" % completed_line)
@@ -183,124 +297,522 @@ class CULComThread(threading.Thread):
                     return completed_line
 
 
+class FrameFilter(object):
+    """Decides on the raw header of a frame whether it is worth decoding.
+
+    message_types is an allow-list of message type ids, frames of other types are dropped.
+    Beyond that, a frame is accepted if its receiver is within receiver_ranges, its sender
+    within sender_ranges, its group in group_ids, sender or receiver in known_devices or its
+    type in always_accepted_types (e.g. PairPing of new devices). Without any of these
+    address criteria configured, all frames of allowed types are accepted.
+    Ranges are given as inclusive (low, high) tuples.
+    """
+
+    def __init__(self, message_types=None, receiver_ranges=(), sender_ranges=(), group_ids=(),
+                 known_devices=(), always_accepted_types=()):
+        self.message_types = set(message_types) if message_types is not None else None
+        self.receiver_ranges = list(receiver_ranges)
+        self.sender_ranges = list(sender_ranges)
+        self.group_ids = set(group_ids)
+        self.known_devices = set(known_devices)
+        self.always_accepted_types = set(always_accepted_types)
+        self.accepted = 0
+        self.filtered = defaultdict(int)
+
+    def accepts(self, raw_frame):
+        """Checks raw frame as received from CUL, frames without complete header are dropped as malformed"""
+
+        try:
+            if len(raw_frame) < 23:
+                raise ValueError("frame too short")
+            msgtype = int(raw_frame[7:9], base=16)
+            sender_id = int(raw_frame[9:15], base=16)
+            receiver_id = int(raw_frame[15:21], base=16)
+            group_id = int(raw_frame[21:23], base=16)
+        except ValueError:
+            # e.g. truncated lines after a reconnect
+            self.filtered['malformed'] += 1
+            return False
+        if self.message_types is not None and msgtype not in self.message_types:
+            self.filtered['message_type'] += 1
+            return False
+        if msgtype in self.always_accepted_types or not (
+                self.receiver_ranges or self.sender_ranges or self.group_ids or self.known_devices):
+            self.accepted += 1
+            return True
+
+        if sender_id in self.known_devices or receiver_id in self.known_devices \
+                or group_id in self.group_ids \
+                or any(low <= receiver_id <= high for low, high in self.receiver_ranges) \
+                or any(low <= sender_id <= high for low, high in self.sender_ranges):
+            self.accepted += 1
+            return True
+        self.filtered['address'] += 1
+        return False
+
+
+class DuplicateFrameFilter(object):
+    """Recognizes retransmitted or relayed copies of a frame seen within the last window seconds.
+
+    Frames are compared by counter, message type, sender and payload of the raw frame, so copies
+    differing in flags, receiver or signal strength are caught as well.
+    """
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self.lookups = 0
+        self.hits = 0
+        self._seen = {}
+        self._seen_order = deque()
+
+    @property
+    def hit_rate(self):
+        return float(self.hits) / self.lookups if self.lookups else 0.0
+
+    def is_duplicate(self, raw_frame, now=None):
+        """Checks raw frame as received from CUL including signal strength"""
+
+        if now is None:
+            now = time.time()
+        expire_before = now - self.window
+        while self._seen_order and self._seen_order[0][0] < expire_before:
+            seen_at, key = self._seen_order.popleft()
+            if self._seen.get(key) == seen_at:
+                del self._seen[key]
+
+        self.lookups += 1
+        key = raw_frame[3:5] + raw_frame[7:15] + raw_frame[23:-2]
+        if key in self._seen:
+            self.hits += 1
+            return True
+        self._seen[key] = now
+        self._seen_order.append((now, key))
+        return False
+
+
 class CULMessageThread(threading.Thread):
-    """High level message processing"""
+    """High level message processing.
 
-    def __init__(self, command_queue, device_path):
+    command_queue takes (msg, payload) tuples of commands to send, optionally extended by an
+    urgent flag as third item to wake up sleeping devices instead of waiting for them.
+    """
+
+    def __init__(self, command_queue, device_path, state_snapshot_path=None, snapshot_interval=300,
+                 duplicate_window=1.0, frame_filter=None, send_queue_size=20, receive_queue_size=100,
+                 stall_timeout=900, serial_factory=None):
         super(CULMessageThread, self).__init__()
         self.command_queue = command_queue
-        self.thermostat_states = defaultdict(dict)
+        self.frame_filter = frame_filter
+        # optional StatePoller, asked once per loop whether to request a status
+        self.poller = None
+        self.duplicate_filter = DuplicateFrameFilter(duplicate_window)
+        self.thermostat_states = ThermostatStates()
+        self.state_snapshot_path = state_snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = time.time()
+        if state_snapshot_path and os.path.exists(state_snapshot_path):
+            try:
+                self.thermostat_states.load(state_snapshot_path)
+                message_logger.info("loaded %i thermostat states from %s" % (len(self.thermostat_states), state_snapshot_path))
+            except (IOError, ValueError, KeyError) as e:
+                message_logger.error("Loading state snapshot %s failed, starting empty. Reason: %s" % (state_snapshot_path, str(e)))
         self.thermostat_states_lock = threading.Lock()
-        self.com_send_queue = Queue.Queue()
-        self.com_receive_queue = Queue.Queue()
-        self.com_thread = CULComThread(self.com_send_queue, self.com_receive_queue, device_path)
+        # command_queue only gets emptied while the CUL keeps up, so a full send queue pushes back to it
+        self.com_send_queue = BoundedQueue(send_queue_size, "reject")
+        # old frames are worth least if processing cannot keep up
+        self.com_receive_queue = BoundedQueue(receive_queue_size, "drop_oldest")
+        self.com_thread = CULComThread(self.com_send_queue, self.com_receive_queue, device_path,
+                                       stall_timeout=stall_timeout, serial_factory=serial_factory)
         self.stop_requested = threading.Event()
         self.pair_as_cube = True
         self.pair_as_wallthermostat = False
         self.pair_as_ShutterContact = False
+        self.unhandled_messages = 0
+        self.message_handlers = dict((msg_id, []) for msg_id in MORITZ_MESSAGE_IDS)
+        self.register_message_handler(PairPingMessage, self._handle_pair_ping)
+        self.register_message_handler(TimeInformationMessage, self._handle_time_information)
+        self.register_message_handler(ThermostatStateMessage, self._handle_thermostat_state)
+        self.register_message_handler(AckMessage, self._handle_ack)
+        self.week_profiles = defaultdict(dict)
+        self._awaiting_ack = {}
+        self._deferred = []
+        self._held = defaultdict(list)
+        self.link_quality = defaultdict(LinkQuality)
+        self.pair_response_latency = LatencyStatistics()
+        self._frame_received_at = time.time()
+        self._counters = itertools.cycle(range(1, 0x100))
 
     def run(self):
-        self.com_thread.start()
+        # transport may have been started earlier to initialize the CUL in parallel
+        if self.com_thread.ident is None:
+            self.com_thread.start()
         while not self.stop_requested.isSet():
-            message = None
+            # all frames received meanwhile, as the receive queue drops the oldest when full
             try:
                 received_msg = self.com_receive_queue.get(True, 0.05)
-                message = MoritzMessage.decode_message(received_msg[:-2])
-                signal_strength = int(received_msg[-2:], base=16)
-                self.respond_to_message(message, signal_strength)
+                while True:
+                    try:
+                        self.process_frame(received_msg)
+                    except MoritzError as e:
+                        message_logger.error("Message parsing failed, ignoring message '%s'. Reason: %s" % (received_msg, str(e)))
+                    received_msg = self.com_receive_queue.get_nowait()
             except Queue.Empty:
                 pass
-            except MoritzError as e:
-                message_logger.error("Message parsing failed, ignoring message '%s'. Reason: %s" % (received_msg, str(e)))
 
-            try:
-                msg, payload = self.command_queue.get(True, 0.05)
-                raw_message = msg.encode_message(payload)
-                message_logger.debug("send type %s" % msg)
-                self.com_send_queue.put(raw_message)
-            except Queue.Empty:
-                pass
+            if not self.com_send_queue.full():
+                try:
+                    command = self.command_queue.get(True, 0.05)
+                    self._process_command(*command)
+                except Queue.Empty:
+                    pass
+                except QueueFullError as e:
+                    message_logger.error("Dropping command %s as send queue is full. Reason: %s" % (command[0], str(e)))
+
+            self._check_awaiting_acks()
+            self._send_deferred()
+            self._check_held()
+            if self.poller is not None:
+                self.poller.poll()
+
+            if self.state_snapshot_path and time.time() - self._last_snapshot > self.snapshot_interval:
+                self.save_state_snapshot()
 
             time.sleep(0.3)
 
+    def process_frame(self, frame):
+        """Handles frame as received from CUL, including signal strength.
+
+        Filters, link quality and state updates share one timestamp, the frame is decoded in
+        one go and its payload only once per handler chain.
+        """
+
+        received_at = time.time()
+        if self.frame_filter is not None and not self.frame_filter.accepts(frame):
+            return
+        if self.duplicate_filter.is_duplicate(frame, received_at):
+            return
+        message, signal_strength = MoritzMessage.decode_frame(frame)
+        self.link_quality[message.sender_id].heard(signal_strength, received_at)
+        self.respond_to_message(message, signal_strength, received_at)
+        if message.sender_id in self._held:
+            # device just transmitted, so it listens for a moment
+            self._release_held(message.sender_id)
+
     def join(self, timeout=None):
         self.com_thread.join(timeout)
         self.stop_requested.set()
         super(CULMessageThread, self).join(timeout)
+        if self.state_snapshot_path:
+            self.save_state_snapshot()
 
-    def respond_to_message(self, msg, signal_strenth):
-        """Internal function to respond to incoming messages where appropriate"""
+    def save_state_snapshot(self):
+        """Checkpoints thermostat_states to state_snapshot_path"""
 
-        if isinstance(msg, PairPingMessage):
-            message_logger.info("received PairPing")
-            # Some peer wants to pair. Let's see...
-            device_pair_request.send(self, msg=msg)
-            if msg.receiver_id == 0x0:
-                # pairing after factory reset
-                if not (self.pair_as_cube or self.pair_as_wallthermostat or self.pair_as_ShutterContact):
-                    message_logger.info("Pairing to new device but we should ignore it")
-                    return
-                resp_msg = PairPongMessage()
-                resp_msg.counter = 1
-                resp_msg.sender_id = CUBE_ID
-                resp_msg.receiver_id = msg.sender_id
-                resp_msg.group_id = msg.group_id
-                if self.com_thread.has_send_budget:
-                    message_logger.info("responding to pair after factory reset")
-                    self.command_queue.put((resp_msg, {"devicetype": "Cube"}))
-                    device_pair_accepted.send(self, resp_msg=resp_msg)
-                else:
-                    message_logger.info("NOT responding to pair after factory reset as no send budget to be on time")
-                return
-            elif msg.receiver_id == CUBE_ID:
-                # pairing after battery replacement
-                resp_msg = PairPongMessage()
-                resp_msg.counter = 1
-                resp_msg.sender_id = CUBE_ID
-                resp_msg.receiver_id = msg.sender_id
-                resp_msg.group_id = msg.group_id
-                if self.com_thread.has_send_budget:
-                    message_logger.info("responding to pair after battery replacement")
-                    self.command_queue.put((resp_msg, {"devicetype": "Cube"}))
-                    device_pair_accepted.send(self, resp_msg=resp_msg)
-                else:
-                    message_logger.info("NOT responding to pair after battery replacement as no send budget to be on time")
+        self._last_snapshot = time.time()
+        try:
+            with self.thermostat_states_lock:
+                self.thermostat_states.save(self.state_snapshot_path)
+        except (IOError, OSError) as e:
+            message_logger.error("Saving state snapshot to %s failed. Reason: %s" % (self.state_snapshot_path, str(e)))
+
+    def next_counter(self):
+        """Returns message counter to use for the next command, needed to match acks to commands"""
+
+        return next(self._counters)
+
+    def set_week_profile(self, receiver_id, profile):
+        """Queues week profile for given thermostat and returns amount of messages queued.
+
+        profile maps day names as in WEEKDAYS to lists of (until, temperature) switch points.
+        Only message parts differing from what the thermostat acknowledged before are sent.
+        Raises QueueFullError if command_queue is bounded and cannot take all of them.
+        """
+
+        changes = changed_parts(self.week_profiles[receiver_id], profile)
+        commands = []
+        for day, part, entries in changes:
+            msg = ConfigWeekProfileMessage()
+            msg.counter = self.next_counter()
+            msg.sender_id = CUBE_ID
+            msg.receiver_id = receiver_id
+            msg.group_id = 0
+            commands.append((msg, {'day': day, 'part': part, 'entries': entries}))
+        # a partially queued profile would leave the thermostat with a mix of old and new one
+        if isinstance(self.command_queue, BoundedQueue):
+            self.command_queue.put_all(commands)
+        else:
+            for command in commands:
+                self.command_queue.put(command)
+        message_logger.info("queued %i week profile messages for 0x%X" % (len(changes), receiver_id))
+        return len(changes)
+
+    def _process_command(self, msg, payload, urgent=False):
+        """Decides whether a command from command_queue is sent now, deferred or held.
+
+        Commands to battery powered devices (those reporting thermostat states) are held until
+        the device transmits next, as it only listens shortly afterwards. Urgent commands and
+        commands held longer than WAKEUP_AFTER are preceded by a WakeUpMessage instead.
+        """
+
+        receiver_id = msg.receiver_id
+        if not receiver_id:
+            self._send_command(msg, payload)
+            return
+        link = self.link_quality[receiver_id]
+        if receiver_id in self.thermostat_states and not link.recently_heard(AWAKE_WINDOW):
+            if urgent and self._send_queue_room() < 2:
+                # wake up and command must fit together, so it gets woken up by _check_held right away
+                message_logger.info("holding urgent %s until send queue has room" % msg)
+                self._hold(msg, payload, 0, time.time() - WAKEUP_AFTER)
                 return
+            elif urgent:
+                self._send_wakeup(receiver_id)
             else:
-                # pair to someone else after battery replacement, don't care
-                message_logger.info("pair after battery replacement sent to other device 0x%X, ignoring" % msg.receiver_id)
+                message_logger.info("holding %s until device wakes up" % msg)
+                self._hold(msg, payload, 0, time.time())
                 return
+        elif link.is_weak and not self.com_thread.has_comfortable_budget:
+            message_logger.info("deferring %s to weak link until send budget is comfortable" % msg)
+            self._deferred.append((msg, payload, 0, time.time()))
+            return
+        self._send_command(msg, payload)
 
-        elif isinstance(msg, TimeInformationMessage):
-            if not msg.payload and msg.receiver_id == CUBE_ID:
-                # time information requested
-                resp_msg = TimeInformationMessage()
-                resp_msg.counter = 1
-                resp_msg.sender_id = CUBE_ID
-                resp_msg.receiver_id = msg.sender_id
-                resp_msg.group_id = msg.group_id
-                message_logger.info("time information requested by 0x%X, responding" % msg.sender_id)
-                self.command_queue.put((resp_msg, datetime.now()))
+    @property
+    def is_idle(self):
+        """Whether no commands wait to be sent, neither queued, held nor deferred"""
+
+        return (self.command_queue.empty() and self.com_send_queue.empty()
+                and not self._held and not self._deferred)
+
+    def request_status(self, receiver_id):
+        """Wakes receiver_id up, its ack carries its current status"""
+
+        self._send_wakeup(receiver_id)
+
+    def _send_wakeup(self, receiver_id):
+        msg = WakeUpMessage()
+        msg.counter = self.next_counter()
+        msg.sender_id = CUBE_ID
+        msg.receiver_id = receiver_id
+        msg.group_id = 0
+        message_logger.info("waking up 0x%X" % receiver_id)
+        self.com_send_queue.put(msg.encode_message({'duration': WAKEUP_DURATION}))
+
+    def _send_queue_room(self):
+        return self.com_send_queue.maxsize - self.com_send_queue.qsize()
+
+    def _hold(self, msg, payload, attempt, held_at):
+        """Holds command until its receiver is heard or woken up.
+
+        Like the coalescing command queue, a command replaces one held before with the same
+        command_coalesce_key, only a retry never replaces the newer command. The earlier
+        held_at is kept so a replaced command does not postpone the wake up.
+        """
+
+        held = self._held[msg.receiver_id]
+        key = command_coalesce_key((msg, payload))
+        for index, (held_msg, held_payload, held_attempt, earlier_held_at) in enumerate(held):
+            if command_coalesce_key((held_msg, held_payload)) == key:
+                if not attempt:
+                    held[index] = (msg, payload, attempt, min(held_at, earlier_held_at))
                 return
+        if len(held) >= MAX_HELD_PER_DEVICE:
+            message_logger.warning("too many commands held for 0x%X, dropping %s" % (msg.receiver_id, held[0][0]))
+            # the next one inherits held_at, so dropping does not postpone the wake up either
+            held[1] = held[1][:3] + (held[0][3],)
+            del held[0]
+        held.append((msg, payload, attempt, held_at))
+
+    def _release_held(self, receiver_id, wake_up=False):
+        """Sends as many commands held for receiver_id as the send queue has room for.
+
+        A wake up is only sent along with at least one command. Commands left over are sent
+        when the device is heard next, e.g. acknowledging the ones sent now.
+        """
+
+        room = self._send_queue_room() - wake_up
+        if room < 1 or receiver_id not in self._held:
+            return
+        held = self._held.pop(receiver_id)
+        if wake_up:
+            self._send_wakeup(receiver_id)
+        for msg, payload, attempt, held_at in held[:room]:
+            self._send_command(msg, payload, attempt)
+        left_over = held[room:]
+        if left_over:
+            if wake_up:
+                # the device listens now, so waking it up again right away is pointless
+                now = time.time()
+                left_over = [(msg, payload, attempt, now) for msg, payload, attempt, held_at in left_over]
+            self._held[receiver_id] = left_over
+
+    def _check_held(self):
+        """Wakes up devices which did not transmit for WAKEUP_AFTER seconds while commands are held"""
+
+        wakeup_before = time.time() - WAKEUP_AFTER
+        for receiver_id, held in self._held.items():
+            if held[0][3] < wakeup_before:
+                self._release_held(receiver_id, wake_up=True)
+
+    def _send_command(self, msg, payload, attempt=0, track_ack=True):
+        """Puts msg on the send queue. Unless track_ack is False, e.g. for answers to requests
+        of a device with fixed counter, it is retried if not acknowledged and counts for link quality"""
+
+        raw_message = msg.encode_message(payload)
+        message_logger.debug("send type %s" % msg)
+        self.com_send_queue.put(raw_message)
+        if msg.receiver_id and track_ack:
+            self.link_quality[msg.receiver_id].command_sent(retry=attempt > 0)
+            self._awaiting_ack[(msg.receiver_id, msg.counter)] = (msg, payload, time.time(), attempt)
+
+    def _check_awaiting_acks(self):
+        """Schedules retries for commands not acknowledged within ACK_TIMEOUT"""
+
+        now = time.time()
+        for key, (msg, payload, sent_at, attempt) in self._awaiting_ack.items():
+            if sent_at < now - ACK_TIMEOUT:
+                del self._awaiting_ack[key]
+                if attempt < MAX_RETRIES:
+                    message_logger.info("no ack received for %s, retrying once device is heard" % msg)
+                    self._hold(msg, payload, attempt + 1, now)
+                else:
+                    message_logger.info("no ack received for %s, giving up" % msg)
 
-        elif isinstance(msg, ThermostatStateMessage):
-            with self.thermostat_states_lock:
-                message_logger.info("thermostat state updated for 0x%X" % msg.sender_id)
-                self.thermostat_states[msg.sender_id].update(msg.decoded_payload)
-                self.thermostat_states[msg.sender_id]['last_updated'] = datetime.now()
-                self.thermostat_states[msg.sender_id]['signal_strenth'] = signal_strenth
-            thermostatstate_received.send(self, msg=msg)
+    def _send_deferred(self):
+        """Sends commands deferred for weak links once the send budget is comfortable"""
+
+        if not self._deferred:
             return
+        now = time.time()
+        still_deferred = []
+        for msg, payload, attempt, deferred_at in self._deferred:
+            if self.com_send_queue.full():
+                ready = False
+            else:
+                ready = self.com_thread.has_comfortable_budget or now - deferred_at > MAX_DEFER
+            if ready:
+                self._send_command(msg, payload, attempt)
+            else:
+                still_deferred.append((msg, payload, attempt, deferred_at))
+        self._deferred = still_deferred
 
-        elif isinstance(msg, AckMessage):
-            if msg.receiver_id == CUBE_ID and msg.decoded_payload["state"] == "ok":
-                thermostatstate_received.send(self, msg=msg)
-                with self.thermostat_states_lock:
-                    message_logger.info("ack and thermostat state updated for 0x%X" % msg.sender_id)
-                    self.thermostat_states[msg.sender_id].update(msg.decoded_payload)
-                    self.thermostat_states[msg.sender_id]['last_updated'] = datetime.now()
-                    self.thermostat_states[msg.sender_id]['signal_strenth'] = signal_strenth
-                return
+    def _command_acknowledged(self, msg, payload):
+        if isinstance(msg, ConfigWeekProfileMessage):
+            self.week_profiles[msg.receiver_id][(payload['day'], payload['part'])] = tuple(payload['entries'])
+        command_acknowledged.send(self, msg=msg, payload=payload)
+
+    def register_message_handler(self, message_type, handler):
+        """Registers handler(msg, signal_strength) to be called for incoming messages of given type.
 
-        message_logger.warning("Unhandled Message of type %s, contains %s" % (msg.__class__.__name__, str(msg)))
+        message_type may either be a message class or its id as listed in MORITZ_MESSAGE_IDS.
+        Handlers are called in order of registration.
+        """
 
+        if not isinstance(message_type, int):
+            message_type = MORITZ_MESSAGE_TYPES[message_type]
+        if message_type not in self.message_handlers:
+            raise UnknownMessageError("Unknown message with id %x" % message_type)
+        self.message_handlers[message_type].append(handler)
+
+    def unregister_message_handler(self, message_type, handler):
+        """Removes handler previously added via register_message_handler"""
+
+        if not isinstance(message_type, int):
+            message_type = MORITZ_MESSAGE_TYPES[message_type]
+        self.message_handlers[message_type].remove(handler)
+
+    def respond_to_message(self, msg, signal_strenth, received_at=None):
+        """Internal function to respond to incoming messages where appropriate"""
+
+        self._frame_received_at = time.time() if received_at is None else received_at
+        handlers = self.message_handlers[MORITZ_MESSAGE_TYPES[msg.__class__]]
+        if not handlers:
+            self.unhandled_messages += 1
+            return
+        for handler in handlers:
+            handler(msg, signal_strenth)
+
+    def _respond_with_pair_pong(self, msg, reason):
+        """Sends PairPong for given PairPing right away if send budget allows to be on time.
+
+        The device only waits a moment for the answer, so it skips command_queue and goes
+        straight to the transport. Returns the PairPong if it was queued, None otherwise.
+        """
+
+        resp_msg = PairPongMessage()
+        resp_msg.counter = 1
+        resp_msg.sender_id = CUBE_ID
+        resp_msg.receiver_id = msg.sender_id
+        resp_msg.group_id = msg.group_id
+        if not self.com_thread.has_send_budget:
+            message_logger.info("NOT responding to pair after %s as no send budget to be on time" % reason)
+            return None
+        try:
+            self._send_command(resp_msg, {"devicetype": "Cube"}, track_ack=False)
+        except QueueFullError:
+            message_logger.error("NOT responding to pair after %s as send queue is full" % reason)
+            return None
+        self.pair_response_latency.add(time.time() - self._frame_received_at)
+        message_logger.info("responded to pair after %s" % reason)
+        if self.frame_filter is not None:
+            self.frame_filter.known_devices.add(msg.sender_id)
+        return resp_msg
+
+    def _handle_pair_ping(self, msg, signal_strenth):
+        message_logger.info("received PairPing")
+        # Some peer wants to pair. Let's see...
+        resp_msg = None
+        if msg.receiver_id == 0x0:
+            # pairing after factory reset
+            if self.pair_as_cube or self.pair_as_wallthermostat or self.pair_as_ShutterContact:
+                resp_msg = self._respond_with_pair_pong(msg, "factory reset")
+            else:
+                message_logger.info("Pairing to new device but we should ignore it")
+        elif msg.receiver_id == CUBE_ID:
+            # pairing after battery replacement
+            resp_msg = self._respond_with_pair_pong(msg, "battery replacement")
+        else:
+            # pair to someone else after battery replacement, don't care
+            message_logger.info("pair after battery replacement sent to other device 0x%X, ignoring" % msg.receiver_id)
+        # receivers are only notified once the answer is on its way, so they cannot delay it
+        device_pair_request.send(self, msg=msg)
+        if resp_msg is not None:
+            device_pair_accepted.send(self, resp_msg=resp_msg)
+
+    def _handle_time_information(self, msg, signal_strenth):
+        if not msg.payload and msg.receiver_id == CUBE_ID:
+            # time information requested
+            resp_msg = TimeInformationMessage()
+            resp_msg.counter = 1
+            resp_msg.sender_id = CUBE_ID
+            resp_msg.receiver_id = msg.sender_id
+            resp_msg.group_id = msg.group_id
+            message_logger.info("time information requested by 0x%X, responding" % msg.sender_id)
+            # the device listens right now, so the answer skips command_queue like a PairPong
+            try:
+                self._send_command(resp_msg, datetime.now(), track_ack=False)
+            except QueueFullError:
+                message_logger.error("NOT responding to time information request as send queue is full")
+
+    def _update_thermostat_state(self, msg, signal_strenth, payload=None):
+        """Merges state into thermostat_states and notifies about changed fields only"""
+
+        if payload is None:
+            payload = msg.decoded_payload
+        with self.thermostat_states_lock:
+            changes = self.thermostat_states.update(msg.sender_id, payload, signal_strenth, self._frame_received_at)
+        if changes:
+            message_logger.info("thermostat state changed for 0x%X: %s" % (msg.sender_id, ", ".join(sorted(changes))))
+            thermostatstate_received.send(self, msg=msg, changes=changes)
+
+    def _handle_thermostat_state(self, msg, signal_strenth):
+        self._update_thermostat_state(msg, signal_strenth)
+
+    def _handle_ack(self, msg, signal_strenth):
+        payload = msg.decoded_payload
+        if msg.receiver_id == CUBE_ID and payload.get("state") == "ok":
+            sent = self._awaiting_ack.pop((msg.sender_id, msg.counter), None)
+            if sent is not None:
+                self.link_quality[msg.sender_id].command_acked()
+                self._command_acknowledged(sent[0], sent[1])
+            self._update_thermostat_state(msg, signal_strenth, payload)
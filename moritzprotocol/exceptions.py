@@ -12,6 +12,7 @@
 # environment constants
 
 # python imports
+import Queue
 
 # environment imports
 
@@ -31,6 +32,12 @@ class UnknownMessageError(MoritzError):
 	pass
 
 
+class InvalidFrameError(MoritzError):
+	"""Received frame is not hex encoded"""
+
+	pass
+
+
 class LengthNotMatchingError(MoritzError):
 	"""Message payload length and indicated length differ"""
 
@@ -43,3 +50,19 @@ class MissingPayloadParameterError(MoritzError):
 	pass
 
 
+class InvalidWeekProfileError(MoritzError):
+	"""Week profile cannot be encoded for transmission"""
+
+	pass
+
+
+class QueueFullError(MoritzError, Queue.Full):
+	"""Bounded queue is full and its overflow policy rejects further items"""
+
+	pass
+
+
+class InvalidRuleError(MoritzError):
+	"""Automation rule definition cannot be understood"""
+
+	pass
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.ipc
+    ~~~~~~~~~~~~~~~~~~
+
+    Plumbing to run the radio engine in its own process.
+
+    The radio process publishes thermostat states into a SharedStateTable, a memory-mapped
+    file of fixed-layout records per device which any number of web processes read without
+    asking the radio process. Commands and everything else go through RadioListener and
+    RadioClient over a local socket.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import mmap
+from multiprocessing.connection import Client, Listener
+import os
+import struct
+import threading
+import time
+
+# environment imports
+import logbook
+
+# custom imports
+from moritzprotocol.states import ThermostatStates
+from moritzprotocol.storage import RECORD, SegmentStorage, to_timestamp
+
+# local constants
+ipc_logger = logbook.Logger("IPC")
+
+# magic, amount of slots, slots in use
+HEADER = struct.Struct("<4sII")
+MAGIC = "MRTZ"
+# sender_id, sequence, stale followed by a storage.RECORD
+SLOT_HEADER = struct.Struct("<II?3x")
+SLOT_SIZE = SLOT_HEADER.size + RECORD.size
+# attempts to read a slot while it is written and seconds to sleep in between
+READ_RETRIES = 100
+READ_RETRY_DELAY = 0.001
+# seconds to wait for radio process to answer a call
+CALL_TIMEOUT = 10
+
+
+class SharedStateTable(object):
+    """Fixed-layout thermostat states in a memory-mapped file, written by one process only.
+
+    Every slot carries a sequence number which is odd while the writer updates the slot,
+    so readers retry instead of returning half written records. If the slot does not get
+    consistent within READ_RETRIES attempts, e.g. as the writer died halfway, the last
+    record read from it is returned.
+    """
+
+    def __init__(self, path, slots=256, writer=False):
+        self.path = path
+        self.writer = writer
+        self._slot_ids = {}
+        # slot: (sender_id, stale, record) last read consistently
+        self._last_read = {}
+        if writer:
+            with open(path, "wb") as table_file:
+                table_file.write(HEADER.pack(MAGIC, slots, 0))
+                table_file.write("\0" * SLOT_SIZE * slots)
+        with open(path, "r+b" if writer else "rb") as table_file:
+            self._mapped = mmap.mmap(table_file.fileno(), 0,
+                                     access=mmap.ACCESS_WRITE if writer else mmap.ACCESS_READ)
+        magic, self.slots, used = HEADER.unpack_from(self._mapped, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is no shared state table" % path)
+
+    @property
+    def used(self):
+        return HEADER.unpack_from(self._mapped, 0)[2]
+
+    def publish(self, sender_id, state):
+        """Writes state of sender_id, allocating a slot for devices not seen before"""
+
+        slot = self._slot_ids.get(sender_id)
+        if slot is None:
+            slot = len(self._slot_ids)
+            if slot >= self.slots:
+                ipc_logger.error("Shared state table full, not publishing 0x%X" % sender_id)
+                return
+            self._slot_ids[sender_id] = slot
+        offset = HEADER.size + slot * SLOT_SIZE
+        sequence = SLOT_HEADER.unpack_from(self._mapped, offset)[1]
+        stale = bool(state.get('stale'))
+        SLOT_HEADER.pack_into(self._mapped, offset, sender_id, sequence + 1, stale)
+        self._mapped[offset + SLOT_HEADER.size:offset + SLOT_SIZE] = \
+            SegmentStorage.encode_record(to_timestamp(state['last_updated']), state)
+        SLOT_HEADER.pack_into(self._mapped, offset, sender_id, sequence + 2, stale)
+        if slot >= self.used:
+            HEADER.pack_into(self._mapped, 0, MAGIC, self.slots, slot + 1)
+
+    def _read_slot(self, slot):
+        """Returns sender_id, stale and record of slot"""
+
+        offset = HEADER.size + slot * SLOT_SIZE
+        for attempt in xrange(READ_RETRIES):
+            sender_id, sequence, stale = SLOT_HEADER.unpack_from(self._mapped, offset)
+            record = self._mapped[offset + SLOT_HEADER.size:offset + SLOT_SIZE]
+            if not sequence % 2 and SLOT_HEADER.unpack_from(self._mapped, offset)[1] == sequence:
+                self._last_read[slot] = (sender_id, stale, record)
+                return sender_id, stale, record
+            time.sleep(READ_RETRY_DELAY)
+        if slot not in self._last_read:
+            raise IOError("Slot %i of shared state table did not get consistent" % slot)
+        ipc_logger.warning("Slot %i of shared state table did not get consistent, using last record" % slot)
+        return self._last_read[slot]
+
+    def as_dict(self, iso_dates=False):
+        """Returns states like ThermostatStates.as_dict()"""
+
+        result = {}
+        for slot in xrange(self.used):
+            sender_id, stale, record = self._read_slot(slot)
+            state = SegmentStorage.decode_record(record)
+            if stale:
+                state['stale'] = True
+            if iso_dates:
+                state['last_updated'] = state['last_updated'].isoformat()
+            if 'signal_strength' in state:
+                state['signal_strenth'] = state.pop('signal_strength')
+            result[sender_id] = state
+        return result
+
+    def as_columns(self):
+        """Returns states like ThermostatStates.as_columns()"""
+
+        states = ThermostatStates()
+        for sender_id, state in sorted(self.as_dict().items()):
+            last_updated = state.pop('last_updated')
+            stale = state.pop('stale', False)
+            states.update(sender_id, state, state.pop('signal_strenth', None), last_updated)
+            if stale:
+                states.mark_stale(sender_id)
+        return states.as_columns()
+
+    def close(self):
+        self._mapped.close()
+
+
+class RadioListener(threading.Thread):
+    """Serves calls of RadioClients by calling methods named in exported on target"""
+
+    def __init__(self, address, authkey, target, exported):
+        super(RadioListener, self).__init__()
+        self.daemon = True
+        self.target = target
+        self.exported = frozenset(exported)
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+        self.listener = Listener(address, authkey=authkey)
+        self.stop_requested = threading.Event()
+
+    def run(self):
+        while not self.stop_requested.isSet():
+            try:
+                connection = self.listener.accept()
+            except Exception as e:
+                if not self.stop_requested.isSet():
+                    ipc_logger.error("Accepting radio client failed. Reason: %s" % str(e))
+                continue
+            worker = threading.Thread(target=self._serve, args=(connection,))
+            worker.daemon = True
+            worker.start()
+
+    def close(self):
+        self.stop_requested.set()
+        self.listener.close()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                name, args = connection.recv()
+                if name not in self.exported:
+                    connection.send(("error", AttributeError("%s is not exported" % name)))
+                    continue
+                try:
+                    connection.send(("ok", getattr(self.target, name)(*args)))
+                except Exception as e:
+                    connection.send(("error", e))
+        except (EOFError, IOError):
+            connection.close()
+
+
+class RadioClient(object):
+    """Calls methods of the radio process, raising its exceptions locally.
+
+    Connections are opened lazily per process, so clients survive forking web workers.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def call(self, name, *args):
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid():
+                self._connection = Client(self.address, authkey=self.authkey)
+                self._pid = os.getpid()
+            try:
+                self._connection.send((name, args))
+                if not self._connection.poll(CALL_TIMEOUT):
+                    raise IOError("Radio process did not answer %s within %is" % (name, CALL_TIMEOUT))
+                status, result = self._connection.recv()
+            except (EOFError, IOError):
+                # a late answer would be mistaken for the next one, so start over
+                self._connection.close()
+                self._connection = None
+                raise
+        if status == "error":
+            raise result
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
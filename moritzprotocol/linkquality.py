@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.linkquality
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Per-device radio link statistics used to decide when sending to a device is worth it
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import time
+
+# environment imports
+
+# custom imports
+
+# local constants
+# below this average signal strength (dBm) or ack rate a link is considered weak
+WEAK_RSSI = -90
+WEAK_ACK_RATE = 0.5
+# commands needed before the ack rate is trusted
+MIN_COMMANDS_FOR_ACK_RATE = 3
+
+
+def rssi_to_dbm(signal_strength):
+    """Converts raw signal strength byte as reported by CUL to dBm"""
+
+    if signal_strength >= 128:
+        signal_strength -= 256
+    return signal_strength / 2.0 - 74
+
+
+class LinkQuality(object):
+    """Moving average of signal strength plus ack statistics of one device"""
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.rssi = None
+        self.last_heard = None
+        self.sent = 0
+        self.acked = 0
+        self.retries = 0
+
+    def heard(self, signal_strength, now=None):
+        """Records reception of a frame of this device"""
+
+        dbm = rssi_to_dbm(signal_strength)
+        if self.rssi is None:
+            self.rssi = dbm
+        else:
+            self.rssi += self.smoothing * (dbm - self.rssi)
+        self.last_heard = now or time.time()
+
+    def command_sent(self, retry=False):
+        self.sent += 1
+        if retry:
+            self.retries += 1
+
+    def command_acked(self):
+        self.acked += 1
+
+    @property
+    def ack_rate(self):
+        return float(self.acked) / self.sent if self.sent else None
+
+    @property
+    def is_weak(self):
+        if self.rssi is not None and self.rssi < WEAK_RSSI:
+            return True
+        return self.sent >= MIN_COMMANDS_FOR_ACK_RATE and self.ack_rate < WEAK_ACK_RATE
+
+    def recently_heard(self, window, now=None):
+        """Whether device transmitted within the last window seconds, so it is awake right now"""
+
+        return self.last_heard is not None and (now or time.time()) - self.last_heard <= window
+
+    def as_dict(self):
+        return {
+            'rssi': round(self.rssi, 1) if self.rssi is not None else None,
+            'last_heard': self.last_heard,
+            'sent': self.sent,
+            'acked': self.acked,
+            'retries': self.retries,
+            'ack_rate': self.ack_rate,
+            'is_weak': self.is_weak,
+        }
@@ -12,14 +12,17 @@
 # environment constants
 
 # python imports
+import binascii
+from collections import defaultdict
 from datetime import datetime
+from itertools import islice
 import struct
 
 # environment imports
 
 # custom imports
 from moritzprotocol.exceptions import (
-	MoritzError, LengthNotMatchingError,
+	MoritzError, InvalidFrameError, LengthNotMatchingError,
 	MissingPayloadParameterError, UnknownMessageError
 )
 
@@ -40,6 +43,15 @@ MODE_IDS = {
 	2: "temporary",
 	3: "boost",
 }
+MODES_BY_NAME = dict((v,k) for k, v in MODE_IDS.items())
+
+# length, counter, flag, msgtype, sender and receiver split into high 16 and low 8 bits, group
+FRAME_HEADER = struct.Struct(">BBBBHBHBB")
+# status bits, valve position and desired temperature of thermostat states and acks
+THERMOSTAT_STATUS = struct.Struct(">bBB")
+
+# MAX! counts days starting at saturday
+WEEKDAYS = ("saturday", "sunday", "monday", "tuesday", "wednesday", "thursday", "friday")
 
 
 class MoritzMessage(object):
@@ -68,20 +80,29 @@ class MoritzMessage(object):
 		if input_string.startswith("Zs"):
 			# outgoing messages can be parsed too, just cut the Z off as it doesn't matter
 			input_string = input_string[1:]
+		return MoritzMessage._decode(input_string, False)[0]
+
+	@staticmethod
+	def decode_frame(frame):
+		"""Decodes frame as received from CUL, returns message and signal strength appended by CUL"""
 
-		# Split MAX message
-		length = int(input_string[1:3], base=16)
-		counter = int(input_string[3:5], base=16)
-		flag = int(input_string[5:7], base=16)
-		msgtype = int(input_string[7:9], base=16)
-		sender_id = int(input_string[9:15], base=16)
-		receiver_id = int(input_string[15:21], base=16)
-		group_id = int(input_string[21:23], base=16)
-		payload = input_string[23:]
+		return MoritzMessage._decode(frame, True)
 
-		# Length: strlen(input_string) / 2 as HEX encoding, +3 for Z and length count
-		if (len(input_string) - 3) != length * 2:
-			raise LengthNotMatchingError("Message length %i not matching indicated length %i" % ((len(input_string) - 3)/2, length))
+	@staticmethod
+	def _decode(input_string, with_signal_strength):
+		# the whole frame is converted at once instead of parsing each field from its own slice
+		trailer = 1 if with_signal_strength else 0
+		if len(input_string) % 2 == 0 or len(input_string) < 3 + (FRAME_HEADER.size - 1 + trailer) * 2:
+			raise LengthNotMatchingError("Message of %i characters too short or not byte aligned" % len(input_string))
+		try:
+			data = binascii.unhexlify(input_string[1:])
+		except TypeError:
+			raise InvalidFrameError("Message is not hex encoded: %s" % input_string)
+		length, counter, flag, msgtype, sender_high, sender_low, receiver_high, receiver_low, group_id = FRAME_HEADER.unpack_from(data)
+
+		# Length: bytes after length byte, without signal strength
+		if len(data) - 1 - trailer != length:
+			raise LengthNotMatchingError("Message length %i not matching indicated length %i" % (len(data) - 1 - trailer, length))
 
 		try:
 			message_class = MORITZ_MESSAGE_IDS[msgtype]
@@ -92,17 +113,16 @@ class MoritzMessage(object):
 		message.counter = counter
 		message.flag = flag
 		message.group_id = group_id
-		message.sender_id = sender_id
-		message.receiver_id = receiver_id
-		message.payload = payload
+		message.sender_id = sender_high << 8 | sender_low
+		message.receiver_id = receiver_high << 8 | receiver_low
+		message.payload = input_string[23:-2] if trailer else input_string[23:]
 
-		return message
+		return message, ord(data[-1]) if trailer else None
 
 	def encode_message(self, payload={}):
 		"""Prepare message to be sent on wire"""
 
-		msg_ids = dict((v,k) for k, v in MORITZ_MESSAGE_IDS.items())
-		msg_id = msg_ids[self.__class__]
+		msg_id = MORITZ_MESSAGE_TYPES[self.__class__]
 
 		message = ""
 		if hasattr(self, 'encode_payload'):
@@ -159,14 +179,15 @@ class AckMessage(MoritzMessage):
 
 	@property
 	def decoded_payload(self):
-		result = {}
+		if len(self.payload) == 8:
+			# FIXME: temporarily accepting the fact that we only handle Thermostat results
+			result = ThermostatStateMessage.decode_status(bytearray.fromhex(self.payload), 1)
+		else:
+			result = {}
 		if self.payload.startswith("01"):
 			result["state"] = "ok"
 		elif self.payload.startswith("81"):
 			result["state"] = "invalid_command"
-		if len(self.payload) == 8:
-			# FIXME: temporarily accepting the fact that we only handle Thermostat results
-			result.update(ThermostatStateMessage.decode_status(self.payload[2:]))
 		return result
 
 
@@ -201,7 +222,32 @@ class TimeInformationMessage(MoritzMessage):
 
 
 class ConfigWeekProfileMessage(MoritzMessage):
-	pass
+	"""Sets one half of a days schedule. First part holds up to 7 switch points, second part up to 6 more.
+	   Each switch point is encoded as (until minutes since midnight, temperature)"""
+
+	@property
+	def decoded_payload(self):
+		day_part = int(self.payload[0:2], base=16)
+		entries = []
+		for pos in range(2, len(self.payload), 4):
+			entry = int(self.payload[pos:pos+4], base=16)
+			entries.append(((entry & 0x1FF) * 5, (entry >> 9) / 2.0))
+		return {
+			'day': WEEKDAYS[day_part & 0x0F],
+			'part': day_part >> 4,
+			'entries': entries,
+		}
+
+	def encode_payload(self, payload):
+		for parameter in ("day", "part", "entries"):
+			if parameter not in payload:
+				raise MissingPayloadParameterError("Missing %s in payload" % parameter)
+
+		encoded_payload = "%X" % payload['part'] + "%X" % WEEKDAYS.index(payload['day'])
+		for until, temperature in payload['entries']:
+			content = "%X" % ((int(temperature*2) << 9) | (until / 5))
+			encoded_payload += content.zfill(4)
+		return encoded_payload
 
 
 class ConfigTemperaturesMessage(MoritzMessage):
@@ -261,8 +307,7 @@ class SetTemperatureMessage(MoritzMessage):
 			desired_temperature = round(payload['desired_temperature']*2)/2.0
 		int_temperature = int(desired_temperature*2)
 
-		modes = dict((v,k) for (k,v) in MODE_IDS.items())
-		mode = modes[payload['mode']]
+		mode = MODES_BY_NAME[payload['mode']]
 
 		content = "%X".upper() % ((mode << 6) | int_temperature)
 		return content.zfill(2)
@@ -288,8 +333,12 @@ class ThermostatStateMessage(MoritzMessage):
 	"""Non-reculary sent by Thermostats to report when valve was moved or command received."""
 
 	@staticmethod
-	def decode_status(payload):
-		status_bits, valve_position, desired_temperature = struct.unpack(">bBB", bytearray.fromhex(payload[0:6]))
+	def decode_status(payload, offset=0):
+		"""Decodes status given as hex string or as bytearray starting at offset"""
+
+		if not isinstance(payload, bytearray):
+			payload = bytearray.fromhex(payload[0:6])
+		status_bits, valve_position, desired_temperature = THERMOSTAT_STATUS.unpack_from(payload, offset)
 		mode = status_bits & 0x3
 		dstsetting = status_bits & 0x04
 		langateway = status_bits & 0x08
@@ -312,14 +361,14 @@ class ThermostatStateMessage(MoritzMessage):
 
 	@property
 	def decoded_payload(self):
-		result = ThermostatStateMessage.decode_status(self.payload)
-		if len(self.payload) > 6:
-			pending_payload = bytearray.fromhex(self.payload[6:])
-			if len(pending_payload) == 3:
+		payload = bytearray.fromhex(self.payload)
+		result = ThermostatStateMessage.decode_status(payload)
+		if len(payload) > 3:
+			if len(payload) == 6:
 				# TODO handle date string
 				pass
-			elif len(pending_payload) == 2 and result['mode'] != 'temporary':
-				result["measured_temperature"] = (((pending_payload[0] & 0x1) << 8) + pending_payload[1]) / 10.0
+			elif len(payload) == 5 and result['mode'] != 'temporary':
+				result["measured_temperature"] = (((payload[3] & 0x1) << 8) + payload[4]) / 10.0
 			else:
 				# unknown....
 				pass
@@ -335,7 +384,12 @@ class SetDisplayActualTemperatureMessage(MoritzMessage):
 
 
 class WakeUpMessage(MoritzMessage):
-	pass
+	"""Keeps a battery powered device listening for further commands. FHEM sends duration 0x3F"""
+
+	def encode_payload(self, payload):
+		if "duration" not in payload:
+			return ""
+		return ("%X" % payload['duration']).zfill(2)
 
 
 class ResetMessage(MoritzMessage):
@@ -379,3 +433,122 @@ MORITZ_MESSAGE_IDS = {
 	0xF1: WakeUpMessage,
 	0xF0: ResetMessage,
 }
+MORITZ_MESSAGE_TYPES = dict((v,k) for k, v in MORITZ_MESSAGE_IDS.items())
+
+
+# Columns returned by decode_messages_bulk. Thermostat fields are only set for ThermostatStateMessages,
+# mode holds the key of MODE_IDS and measured_temperature is NaN where not reported
+BULK_MESSAGE_DTYPE = [
+	('valid', '?'),
+	('counter', 'u1'),
+	('flag', 'u1'),
+	('msgtype', 'u1'),
+	('sender_id', 'u4'),
+	('receiver_id', 'u4'),
+	('group_id', 'u1'),
+	('signal_strength', 'u1'),
+	('mode', 'u1'),
+	('valve_position', 'u1'),
+	('desired_temperature', 'f4'),
+	('measured_temperature', 'f4'),
+	('dstsetting', '?'),
+	('langateway', '?'),
+	('is_locked', '?'),
+	('rferror', '?'),
+	('battery_low', '?'),
+]
+
+
+def decode_messages_bulk(frames, with_signal_strength=True, chunk_size=100000):
+	"""Decodes many raw frames at once into a numpy structured array of BULK_MESSAGE_DTYPE.
+
+	frames may be any iterable of lines, e.g. an open capture file. Lines are expected as
+	received from CUL including the trailing signal strength byte unless with_signal_strength
+	is False. Outgoing Zs lines never carry one. Frames which decode_message would reject and
+	thermostat states too short for decoded_payload get valid set to False.
+	Requires numpy, which is imported on first use only.
+	"""
+
+	import numpy
+
+	hex_values = numpy.full(256, 0xFF, dtype=numpy.uint8)
+	for value, char in enumerate("0123456789ABCDEF"):
+		hex_values[ord(char)] = hex_values[ord(char.lower())] = value
+	known_types = numpy.zeros(256, dtype=bool)
+	known_types[MORITZ_MESSAGE_IDS.keys()] = True
+	received_trailer = 1 if with_signal_strength else 0
+	state_type = MORITZ_MESSAGE_TYPES[ThermostatStateMessage]
+
+	def decode_chunk(lines, trailers):
+		result = numpy.zeros(len(lines), dtype=BULK_MESSAGE_DTYPE)
+		result['measured_temperature'] = numpy.nan
+		# equally long frames form a fixed-width character matrix which is decoded at once
+		rows_by_length = defaultdict(list)
+		for row, line in enumerate(lines):
+			rows_by_length[len(line), trailers[row]].append(row)
+		for (line_length, trailer), rows in rows_by_length.items():
+			byte_count = (line_length - 1) / 2
+			if line_length % 2 == 0 or byte_count < 11 + trailer:
+				continue
+			chars = numpy.frombuffer("".join(lines[row] for row in rows), dtype=numpy.uint8)
+			nibbles = hex_values[chars.reshape(len(rows), line_length)[:, 1:]]
+			frame = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+			valid = (nibbles != 0xFF).all(axis=1) & (frame[:, 0] == byte_count - 1 - trailer) & known_types[frame[:, 3]]
+			payload = frame[:, 11:byte_count - trailer]
+			if payload.shape[1] < 3:
+				# decoded_payload rejects these, so they must not pass as a state in auto mode
+				valid &= frame[:, 3] != state_type
+
+			# usually all frames share one length, so work on the result directly instead of a copy
+			columns = result if len(rows) == len(lines) else result[rows]
+			columns['valid'] = valid
+			columns['counter'] = frame[:, 1]
+			columns['flag'] = frame[:, 2]
+			columns['msgtype'] = frame[:, 3]
+			columns['sender_id'] = (frame[:, 4].astype(numpy.uint32) << 16) | (frame[:, 5].astype(numpy.uint32) << 8) | frame[:, 6]
+			columns['receiver_id'] = (frame[:, 7].astype(numpy.uint32) << 16) | (frame[:, 8].astype(numpy.uint32) << 8) | frame[:, 9]
+			columns['group_id'] = frame[:, 10]
+			if trailer:
+				columns['signal_strength'] = frame[:, -1]
+
+			is_state = valid & (frame[:, 3] == state_type)
+			if payload.shape[1] >= 3 and is_state.any():
+				# same bit handling as ThermostatStateMessage.decode_status
+				status_bits = payload[:, 0].astype(numpy.int8)
+				high_bits = status_bits.astype(numpy.int16) >> 9
+				mode = status_bits & 0x3
+				columns['mode'] = numpy.where(is_state, mode, 0)
+				columns['valve_position'] = numpy.where(is_state, payload[:, 1], 0)
+				columns['desired_temperature'] = numpy.where(is_state, (payload[:, 2] & 0x7F) / 2.0, 0)
+				columns['dstsetting'] = is_state & (status_bits & 0x04 != 0)
+				columns['langateway'] = is_state & (status_bits & 0x08 != 0)
+				columns['is_locked'] = is_state & (high_bits & 0x1 != 0)
+				columns['rferror'] = is_state & (high_bits & 0x2 != 0)
+				columns['battery_low'] = is_state & (high_bits & 0x4 != 0)
+				if payload.shape[1] == 5:
+					measured = (((payload[:, 3] & 0x1).astype(numpy.uint16) << 8) + payload[:, 4]) / 10.0
+					columns['measured_temperature'] = numpy.where(is_state & (mode != 2), measured, numpy.nan)
+			if columns is not result:
+				result[rows] = columns
+		return result
+
+	chunks = []
+	frames = iter(frames)
+	while True:
+		lines = []
+		trailers = []
+		for line in islice(frames, chunk_size):
+			line = line.strip()
+			if line.startswith("Zs"):
+				# outgoing messages can be parsed too, just cut the Z off as it doesn't matter
+				lines.append(line[1:])
+				trailers.append(0)
+			else:
+				lines.append(line)
+				trailers.append(received_trailer)
+		if not lines:
+			break
+		chunks.append(decode_chunk(lines, trailers))
+	if not chunks:
+		return numpy.zeros(0, dtype=BULK_MESSAGE_DTYPE)
+	return numpy.concatenate(chunks)
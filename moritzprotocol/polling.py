@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.polling
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional polling of thermostats whose state got stale, as they only report on their own
+    when their valve moves.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import time
+
+# environment imports
+import logbook
+
+# custom imports
+from moritzprotocol.exceptions import QueueFullError
+
+# local constants
+poll_logger = logbook.Logger("Polling")
+
+
+class StatePoller(object):
+    """Requests the status of the thermostat whose state is stalest, using surplus send budget only.
+
+    Attached as poller to a CULMessageThread, poll() is called once per loop of its thread. A
+    status is requested at most every interval seconds, only if the state is older than
+    min_age, no command waits to be sent and the last reported send budget is at least
+    min_budget ms. So user commands always come first and budget stays available for them.
+
+    Devices are ordered by time since their state was updated or they were polled, whatever
+    happened last. A polled device thus moves to the end of the line like in a round-robin,
+    while devices reporting on their own rarely get polled at all.
+    """
+
+    def __init__(self, message_thread, interval=60, min_age=1800, min_budget=None):
+        self.message_thread = message_thread
+        self.interval = interval
+        self.min_age = min_age
+        # defaults to what sending to weak links requires
+        self.min_budget = min_budget
+        self._last_poll = 0
+        self._polled_at = {}
+        self.polls = 0
+        self.skipped_busy = 0
+        self.skipped_budget = 0
+
+    def has_surplus_budget(self):
+        com_thread = self.message_thread.com_thread
+        if self.min_budget is None:
+            return com_thread.has_comfortable_budget
+        return com_thread.send_budget >= self.min_budget
+
+    def stalest(self, now=None):
+        """Returns (sender_id, age) of the device to poll next or None if none is stale enough"""
+
+        now = time.time() if now is None else now
+        with self.message_thread.thermostat_states_lock:
+            ages = self.message_thread.thermostat_states.ages(now)
+        polled_at = self._polled_at
+        candidate = None
+        for sender_id, age in ages:
+            if sender_id in polled_at:
+                age = min(age, now - polled_at[sender_id])
+            if age >= self.min_age and (candidate is None or age > candidate[1]):
+                candidate = (sender_id, age)
+        return candidate
+
+    def poll(self, now=None):
+        """Requests status of the stalest device if due and budget allows. Returns its sender_id or None"""
+
+        now = time.time() if now is None else now
+        if now - self._last_poll < self.interval:
+            return None
+        self._last_poll = now
+        if not self.message_thread.is_idle:
+            self.skipped_busy += 1
+            return None
+        if not self.has_surplus_budget():
+            self.skipped_budget += 1
+            return None
+        candidate = self.stalest(now)
+        if candidate is None:
+            return None
+        sender_id, age = candidate
+        try:
+            self.message_thread.request_status(sender_id)
+        except QueueFullError:
+            self.skipped_busy += 1
+            return None
+        poll_logger.info("requesting status of 0x%X, stale for %is" % (sender_id, age))
+        self._polled_at[sender_id] = now
+        self.polls += 1
+        return sender_id
+
+    def statistics(self):
+        return {
+            'polls': self.polls,
+            'skipped_busy': self.skipped_busy,
+            'skipped_budget': self.skipped_budget,
+        }
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.queues
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Bounded queues between threads. Instead of blocking or growing without limit,
+    each queue has an explicit policy what happens when it is full.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import Queue
+
+# environment imports
+
+# custom imports
+from moritzprotocol.exceptions import QueueFullError
+from moritzprotocol.messages import ConfigWeekProfileMessage
+
+# local constants
+OVERFLOW_POLICIES = ("reject", "drop_oldest", "coalesce")
+
+
+def command_coalesce_key(item):
+    """Commands to the same receiver replace each other, except for different week profile parts"""
+
+    msg, payload = item[:2]
+    if isinstance(msg, ConfigWeekProfileMessage):
+        return msg.__class__, msg.receiver_id, msg.group_id, payload['day'], payload['part']
+    return msg.__class__, msg.receiver_id, msg.group_id
+
+
+class BoundedQueue(Queue.Queue):
+    """Queue.Queue whose put() never blocks but applies overflow_policy when full:
+
+    reject raises QueueFullError, drop_oldest discards the oldest queued item and coalesce
+    replaces a queued item having the same coalesce_key (even if not full yet), rejecting
+    if there is none to replace.
+    """
+
+    def __init__(self, maxsize=100, overflow_policy="reject", coalesce_key=command_coalesce_key):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % overflow_policy)
+        Queue.Queue.__init__(self, maxsize)
+        self.overflow_policy = overflow_policy
+        self.coalesce_key = coalesce_key
+        self.rejected = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, item, block=False, timeout=None):
+        with self.not_full:
+            self._put_item(item)
+
+    def put_all(self, items):
+        """Puts all items or, if the policy rejects any of them, none at all"""
+
+        with self.not_full:
+            if 0 < self.maxsize and self.overflow_policy != "drop_oldest":
+                keys = set()
+                if self.overflow_policy == "coalesce":
+                    keys.update(self.coalesce_key(queued) for queued in self.queue)
+                needed = 0
+                for item in items:
+                    if self.overflow_policy == "coalesce":
+                        key = self.coalesce_key(item)
+                        if key in keys:
+                            continue
+                        keys.add(key)
+                    needed += 1
+                if self._qsize() + needed > self.maxsize:
+                    self.rejected += len(items)
+                    raise QueueFullError("Queue with %i items cannot take %i more" % (self.maxsize, needed))
+            for item in items:
+                self._put_item(item)
+
+    def _put_item(self, item):
+        if self.overflow_policy == "coalesce":
+            key = self.coalesce_key(item)
+            for index, queued in enumerate(self.queue):
+                if self.coalesce_key(queued) == key:
+                    self.queue[index] = item
+                    self.coalesced += 1
+                    return
+        if 0 < self.maxsize <= self._qsize():
+            if self.overflow_policy == "drop_oldest":
+                self._get()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+            else:
+                self.rejected += 1
+                raise QueueFullError("Queue full with %i items" % self.maxsize)
+        self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def statistics(self):
+        """Returns fill level and overflow counters"""
+
+        return {
+            'size': self.qsize(),
+            'maxsize': self.maxsize,
+            'full': self.full(),
+            'overflow_policy': self.overflow_policy,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.rules
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Local automation: declarative rules evaluated on state changes, queueing commands
+    directly instead of round-tripping through an external poller.
+
+    A rule as loaded from JSON looks like
+
+        {"name": "living room too warm", "device": "0E016C", "field": "measured_temperature",
+         "op": ">=", "value": 24,
+         "then": {"receivers": ["0E016C", "0E016D"], "mode": "manual", "desired_temperature": 17}}
+
+    device may be left out to match any device, receivers may be "sender" to address the
+    device the change came from. A rule fires when its condition becomes true for a device,
+    not again until it was false in between.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import defaultdict
+import json
+import operator
+import time
+
+# environment imports
+import logbook
+
+# custom imports
+from moritzprotocol.communication import CUBE_ID
+from moritzprotocol.exceptions import InvalidRuleError, QueueFullError
+from moritzprotocol.messages import MODE_IDS, SetTemperatureMessage
+from moritzprotocol.signals import thermostatstate_received
+from moritzprotocol.stats import LatencyStatistics
+
+# local constants
+rules_logger = logbook.Logger("Rules")
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+class Rule(object):
+    """Condition on one field of one or any device and the temperature to set if it becomes true"""
+
+    def __init__(self, name, field, op, value, receivers, mode, desired_temperature, device=None, urgent=False):
+        if op not in OPERATORS:
+            raise InvalidRuleError("Rule %s: unknown operator %s" % (name, op))
+        if mode not in MODE_IDS.values():
+            raise InvalidRuleError("Rule %s: unknown mode %s" % (name, mode))
+        if receivers != "sender" and not receivers:
+            raise InvalidRuleError("Rule %s: no receivers" % name)
+        self.name = name
+        self.device = device
+        self.field = field
+        self.op = op
+        self.value = value
+        self.receivers = receivers
+        self.mode = mode
+        self.desired_temperature = desired_temperature
+        self.urgent = urgent
+        self.fired = 0
+
+    @classmethod
+    def from_dict(cls, definition):
+        """Creates rule from JSON definition as shown in module documentation"""
+
+        try:
+            then = definition['then']
+            receivers = then['receivers']
+            if receivers != "sender":
+                receivers = [int(receiver, base=16) for receiver in receivers]
+            return cls(
+                name=definition.get('name', definition['field']),
+                device=int(definition['device'], base=16) if 'device' in definition else None,
+                field=definition['field'],
+                op=definition.get('op', "=="),
+                value=definition['value'],
+                receivers=receivers,
+                mode=then.get('mode', "manual"),
+                desired_temperature=float(then['desired_temperature']),
+                urgent=bool(then.get('urgent', False)),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidRuleError("Rule %s invalid: %s" % (definition.get('name', definition), str(e)))
+
+    def matches(self, value):
+        return OPERATORS[self.op](value, self.value)
+
+
+def load_rules(path):
+    """Returns list of Rules defined in JSON file at path"""
+
+    with open(path) as rules_file:
+        try:
+            definitions = json.load(rules_file)
+        except ValueError as e:
+            raise InvalidRuleError("%s is no valid JSON: %s" % (path, str(e)))
+    return [Rule.from_dict(definition) for definition in definitions]
+
+
+class RuleEngine(object):
+    """Evaluates rules on state changes of message_thread and queues resulting commands.
+
+    Rules are indexed by (device, field), so a change only costs lookups for its changed
+    fields. Other signals sent with msg and changes keywords, e.g. for window contacts once
+    those are decoded, can be connected via subscribe().
+    """
+
+    def __init__(self, message_thread, rules=()):
+        self.message_thread = message_thread
+        self.rules = []
+        self._index = defaultdict(list)
+        # (rule, sender_id) pairs whose condition currently holds
+        self._active = set()
+        self.evaluation_time = LatencyStatistics()
+        for rule in rules:
+            self.add_rule(rule)
+        self.subscribe(thermostatstate_received)
+
+    def add_rule(self, rule):
+        self.rules.append(rule)
+        self._index[(rule.device, rule.field)].append(rule)
+
+    def subscribe(self, signal):
+        signal.connect(self._state_changed, sender=self.message_thread, weak=False)
+
+    def _state_changed(self, sender, **kw):
+        self.evaluate(kw['msg'].sender_id, kw['changes'])
+
+    def evaluate(self, sender_id, changes):
+        """Checks rules on changed fields of sender_id and queues commands of rules becoming true"""
+
+        started = time.time()
+        index = self._index
+        for field, value in changes.iteritems():
+            for rule in index.get((sender_id, field), []) + index.get((None, field), []):
+                key = (rule, sender_id)
+                if not rule.matches(value):
+                    self._active.discard(key)
+                elif key not in self._active:
+                    self._active.add(key)
+                    self._fire(rule, sender_id)
+        self.evaluation_time.add(time.time() - started)
+
+    def _fire(self, rule, sender_id):
+        rule.fired += 1
+        receivers = [sender_id] if rule.receivers == "sender" else rule.receivers
+        rules_logger.info("rule %s fired for 0x%X, setting %s %.1f on %s" % (
+            rule.name, sender_id, rule.mode, rule.desired_temperature, ", ".join("0x%X" % receiver for receiver in receivers)))
+        for receiver_id in receivers:
+            msg = SetTemperatureMessage()
+            msg.counter = self.message_thread.next_counter()
+            msg.sender_id = CUBE_ID
+            msg.receiver_id = receiver_id
+            msg.group_id = 0
+            try:
+                self.message_thread.command_queue.put(
+                    (msg, {'desired_temperature': rule.desired_temperature, 'mode': rule.mode}, rule.urgent))
+            except QueueFullError:
+                rules_logger.error("rule %s could not queue command for 0x%X as command queue is full" % (rule.name, receiver_id))
+
+    def statistics(self):
+        return {
+            'rules': dict((rule.name, {'fired': rule.fired}) for rule in self.rules),
+            'evaluation_time': self.evaluation_time.as_dict(),
+        }
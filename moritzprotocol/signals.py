@@ -22,4 +22,7 @@ from blinker import signal
 device_pair_request = signal('device_pair_request')
 device_pair_accepted = signal('device_pair_accepted')
 
+# only sent if state changed, changes keyword holds changed fields
 thermostatstate_received = signal('thermostatstate_received')
+
+command_acknowledged = signal('command_acknowledged')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.simulation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Simulated CUL with thermostats in radio range, for load tests and benchmarks without hardware.
+
+    SimulatedCUL replaces the serial port of CULComThread:
+
+        cul = SimulatedCUL(range(0x100000, 0x100032), report_interval=30)
+        message_thread = CULMessageThread(command_queue, "simulated", serial_factory=cul.open)
+
+    It answers version and budget requests, enforces the 1% send budget like the CUL does,
+    lets each thermostat report its state every report_interval seconds and acknowledges
+    commands addressed to simulated thermostats after ack_delay seconds. Everything happens
+    on the calls of the com thread, so no extra thread is involved.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import deque
+import heapq
+import random
+import time
+
+# environment imports
+
+# custom imports
+from moritzprotocol.communication import CUBE_ID
+from moritzprotocol.exceptions import MoritzError
+from moritzprotocol.messages import MoritzMessage, SetTemperatureMessage, MODES_BY_NAME
+
+# local constants
+# budget regained per second in ms, 1% of the time
+BUDGET_PER_SECOND = 10
+MAX_BUDGET = 36000
+
+
+class SimulatedThermostat(object):
+    """State of one simulated thermostat as encoded into its status payload"""
+
+    def __init__(self, sender_id, signal_strength):
+        self.sender_id = sender_id
+        self.signal_strength = signal_strength
+        self.counter = 0
+        self.mode = "auto"
+        self.desired_temperature = 21.0
+        self.measured_temperature = round(random.uniform(17, 23), 1)
+        self.valve_position = random.randint(0, 100)
+
+    def next_counter(self):
+        self.counter = (self.counter + 1) % 0x100
+        return self.counter
+
+    def status(self):
+        """Returns status bits, valve position and desired temperature as hex"""
+
+        # dst and lan gateway bits set like a thermostat paired to a cube
+        return "%02X%02X%02X" % (MODES_BY_NAME[self.mode] | 0x0C, self.valve_position, int(self.desired_temperature * 2))
+
+    def drift(self):
+        """Lets measured temperature and valve move a bit, as happens between two reports"""
+
+        self.measured_temperature = round(min(max(self.measured_temperature + random.uniform(-0.2, 0.2), 5), 30), 1)
+        self.valve_position = min(max(self.valve_position + random.randint(-5, 5), 0), 100)
+
+
+class SimulatedCUL(object):
+    """Serial port replacement emulating a CUL, see module documentation"""
+
+    def __init__(self, sender_ids, report_interval=180, ack_delay=0.1, ack_loss=0.0, budget=MAX_BUDGET, version="V 1.61 CUL868"):
+        self.thermostats = dict((sender_id, SimulatedThermostat(sender_id, random.randint(0x10, 0x60))) for sender_id in sender_ids)
+        self.report_interval = report_interval
+        self.ack_delay = ack_delay
+        self.ack_loss = ack_loss
+        self.version = version
+        self._budget = budget
+        self._budget_at = time.time()
+        # reports are spread over the first interval like thermostats powered up at random times
+        now = time.time()
+        self._reports = [(now + random.uniform(0, report_interval), sender_id) for sender_id in self.thermostats]
+        heapq.heapify(self._reports)
+        self._acks = deque()
+        self._lines = deque()
+        self._line = ""
+        self.commands_received = 0
+        self.reports_sent = 0
+        self.acks_sent = 0
+        self.overflows = 0
+
+    def open(self, device_path):
+        """Usable as serial_factory, a reopened port starts without buffered output"""
+
+        self._lines.clear()
+        self._line = ""
+        return self
+
+    def close(self):
+        pass
+
+    def budget(self, now=None):
+        """Returns send budget in ms regained until now"""
+
+        now = time.time() if now is None else now
+        self._budget = min(self._budget + (now - self._budget_at) * BUDGET_PER_SECOND, MAX_BUDGET)
+        self._budget_at = now
+        return self._budget
+
+    def write(self, data):
+        for command in data.split("\r\n"):
+            if command:
+                self._handle(command)
+
+    def _handle(self, command):
+        if command == "V":
+            self._lines.append(self.version)
+        elif command == "X":
+            self._lines.append("21  %i" % (self.budget() / 10))
+        elif command.startswith("Zs"):
+            self.commands_received += 1
+            # same estimate of airtime as CULComThread uses
+            airtime = len(command) * 10
+            if self.budget() < airtime:
+                self.overflows += 1
+                self._lines.append("LOVF")
+                return
+            self._budget -= airtime
+            self._command(command)
+
+    def _command(self, command):
+        try:
+            msg = MoritzMessage.decode_message(command)
+        except MoritzError:
+            return
+        thermostat = self.thermostats.get(msg.receiver_id)
+        if thermostat is None:
+            return
+        if isinstance(msg, SetTemperatureMessage):
+            payload = msg.decoded_payload
+            thermostat.mode = payload['mode']
+            thermostat.desired_temperature = payload['desired_temperature']
+        if random.random() < self.ack_loss:
+            return
+        frame = "Z0E%02X0202%06X%06X0001%s%02X" % (
+            msg.counter, thermostat.sender_id, CUBE_ID, thermostat.status(), thermostat.signal_strength)
+        self._acks.append((time.time() + self.ack_delay, frame))
+
+    def _tick(self):
+        """Moves reports and acks which are due into the output"""
+
+        now = time.time()
+        acks = self._acks
+        while acks and acks[0][0] <= now:
+            self._lines.append(acks.popleft()[1])
+            self.acks_sent += 1
+        reports = self._reports
+        while reports and reports[0][0] <= now:
+            due, sender_id = reports[0]
+            due += self.report_interval
+            if due <= now:
+                # a thermostat does not catch up on reports missed while nobody asked for output
+                due = now + self.report_interval
+            heapq.heapreplace(reports, (due, sender_id))
+            thermostat = self.thermostats[sender_id]
+            thermostat.drift()
+            measured = int(round(thermostat.measured_temperature * 10))
+            self._lines.append("Z0F%02X0460%06X%06X00%s%04X%02X" % (
+                thermostat.next_counter(), sender_id, CUBE_ID, thermostat.status(), measured, thermostat.signal_strength))
+            self.reports_sent += 1
+
+    def inWaiting(self):
+        if not self._line:
+            self._tick()
+            if self._lines:
+                self._line = self._lines.popleft() + "\r\n"
+        return len(self._line)
+
+    def read(self, size=1):
+        data, self._line = self._line[:size], self._line[size:]
+        return data
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.states
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    In-memory store of the last known state of each device
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from array import array
+from collections import Mapping
+from datetime import datetime
+from itertools import izip
+import json
+import os
+import time
+
+# environment imports
+
+# custom imports
+from moritzprotocol.messages import MODE_IDS, MODES_BY_NAME
+
+# local constants
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# name: (array typecode, unknown value, encode, decode) of numeric fields
+# decode is mapped over whole columns, so builtin callables are used where possible
+COLUMNS = {
+    'mode': ('b', -1, MODES_BY_NAME.__getitem__, MODE_IDS.get),
+    'desired_temperature': ('h', -1, lambda value: int(value * 2), (2.0).__rtruediv__),
+    'measured_temperature': ('h', -0x8000, lambda value: int(round(value * 10)), (10.0).__rtruediv__),
+    'valve_position': ('h', -1, int, int),
+}
+# fields stored as bits, stale is set for states restored from a snapshot
+FLAGS = ("dstsetting", "langateway", "is_locked", "rferror", "battery_low", "stale")
+FLAG_BITS = dict((name, 1 << bit) for bit, name in enumerate(FLAGS))
+NOT_STALE = 0xFF & ~FLAG_BITS['stale']
+
+
+_flag_fields = {}
+
+
+def flag_fields(known, flags):
+    """Returns dict of known flags, cached as only few combinations occur"""
+
+    key = known << 8 | flags
+    fields = _flag_fields.get(key)
+    if fields is None:
+        fields = _flag_fields[key] = dict((name, bool(flags & bit)) for name, bit in FLAG_BITS.items() if known & bit)
+    return fields
+
+
+def to_epoch(value):
+    """Converts naive local datetime to seconds since epoch"""
+
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+class ThermostatStates(object):
+    """Last known state per thermostat, keyed by sender_id.
+
+    update() merges decoded payloads into the stored state and reports which fields actually
+    changed, so repeated identical status messages do not need to be processed any further.
+
+    Known fields are kept in one array per field, indexed by a slot number per device, so a
+    state costs a few bytes instead of a dict with datetime. Times are kept as seconds since epoch. Item access returns a read-only
+    StateView, as_dict() builds plain dicts of all states in one go. Fields not known in
+    advance are kept in a dict per device.
+
+    States can be saved to and loaded from a snapshot file. Loaded states are marked as stale
+    until the thermostat reports again.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._sender_ids = []
+        self._last_updated = array('d')
+        # ISO rendering of last_updated, done once per update when first asked for
+        self._last_updated_iso = []
+        self._signal_strength = array('h')
+        self._flags_known = array('B')
+        self._flags = array('B')
+        self._columns = dict((name, array(typecode)) for name, (typecode, _, _, _) in COLUMNS.items())
+        self._extras = []
+
+    def _slot(self, sender_id):
+        slot = self._slots.get(sender_id)
+        if slot is None:
+            slot = self._slots[sender_id] = len(self._sender_ids)
+            self._sender_ids.append(sender_id)
+            self._last_updated.append(0.0)
+            self._last_updated_iso.append(None)
+            self._signal_strength.append(-1)
+            self._flags_known.append(0)
+            self._flags.append(0)
+            for name, (_, unknown, _, _) in COLUMNS.items():
+                self._columns[name].append(unknown)
+            self._extras.append(None)
+        return slot
+
+    def update(self, sender_id, payload, signal_strength, timestamp=None):
+        """Merges payload into state of sender_id and returns dict of changed fields.
+
+        timestamp may be given as datetime or seconds since epoch, defaults to now.
+        """
+
+        slot = self._slots.get(sender_id)
+        if slot is None:
+            slot = self._slot(sender_id)
+        changes = {}
+        columns = self._columns
+        payload_known = payload_flags = 0
+        for key, value in payload.iteritems():
+            column = columns.get(key)
+            if column is not None:
+                encoded = COLUMNS[key][2](value)
+                if column[slot] != encoded:
+                    column[slot] = encoded
+                    changes[key] = value
+            elif key in FLAG_BITS:
+                payload_known |= FLAG_BITS[key]
+                if value:
+                    payload_flags |= FLAG_BITS[key]
+            else:
+                extras = self._extras[slot]
+                if extras is None:
+                    extras = self._extras[slot] = {}
+                if key not in extras or extras[key] != value:
+                    extras[key] = value
+                    changes[key] = value
+        known, flags = self._flags_known[slot], self._flags[slot]
+        changed_flags = payload_known & ~known | (payload_flags ^ flags) & payload_known & known
+        if changed_flags:
+            for name, bit in FLAG_BITS.iteritems():
+                if changed_flags & bit:
+                    changes[name] = bool(payload_flags & bit)
+        self._flags[slot] = flags & ~payload_known | payload_flags
+        self._flags_known[slot] = (known | payload_known) & NOT_STALE
+        if timestamp is None:
+            timestamp = time.time()
+        elif not isinstance(timestamp, float):
+            timestamp = to_epoch(timestamp)
+        self._last_updated[slot] = timestamp
+        self._last_updated_iso[slot] = None
+        self._signal_strength[slot] = -1 if signal_strength is None else signal_strength
+        return changes
+
+    def _iso_last_updated(self, slot):
+        rendered = self._last_updated_iso[slot]
+        if rendered is None:
+            rendered = self._last_updated_iso[slot] = datetime.fromtimestamp(self._last_updated[slot]).isoformat()
+        return rendered
+
+    def _build(self, slots, iso_dates=False):
+        """Returns list of state dicts for slots, decoding column by column"""
+
+        signal_strength = self._signal_strength
+        if iso_dates:
+            last_updated = [self._iso_last_updated(slot) for slot in slots]
+        else:
+            last_updated = [datetime.fromtimestamp(self._last_updated[slot]) for slot in slots]
+        states = [{
+            'last_updated': timestamp,
+            'signal_strenth': signal_strength[slot] if signal_strength[slot] != -1 else None,
+        } for slot, timestamp in izip(slots, last_updated)]
+        for name, column in self._columns.iteritems():
+            _, unknown, _, decode = COLUMNS[name]
+            raw = [column[slot] for slot in slots]
+            for state, value, decoded in izip(states, raw, map(decode, raw)):
+                if value != unknown:
+                    state[name] = decoded
+        known, flags, extras = self._flags_known, self._flags, self._extras
+        for state, slot in izip(states, slots):
+            state.update(flag_fields(known[slot], flags[slot]))
+            if extras[slot]:
+                state.update(extras[slot])
+        return states
+
+    def _field(self, slot, key):
+        """Returns single field of slot, raising KeyError if unknown"""
+
+        if key in COLUMNS:
+            value = self._columns[key][slot]
+            if value == COLUMNS[key][1]:
+                raise KeyError(key)
+            return COLUMNS[key][3](value)
+        elif key in FLAG_BITS:
+            if not self._flags_known[slot] & FLAG_BITS[key]:
+                raise KeyError(key)
+            return bool(self._flags[slot] & FLAG_BITS[key])
+        elif key == 'last_updated':
+            return datetime.fromtimestamp(self._last_updated[slot])
+        elif key == 'signal_strenth':
+            return self._signal_strength[slot] if self._signal_strength[slot] != -1 else None
+        return (self._extras[slot] or {})[key]
+
+    def as_dict(self, iso_dates=False):
+        """Returns copy of all states suitable for serialization, last_updated as ISO string if iso_dates"""
+
+        return dict(izip(self._sender_ids, self._build(xrange(len(self._sender_ids)), iso_dates)))
+
+    def as_columns(self):
+        """Returns all known fields as one list per field, ordered like the sender_id list.
+
+        Unknown values are None, last_updated is given in seconds since epoch. Fields not
+        known in advance are left out. Much cheaper than as_dict() for many devices, as
+        neither dicts nor datetimes are built per device.
+        """
+
+        result = {
+            'sender_id': list(self._sender_ids),
+            'last_updated': self._last_updated.tolist(),
+            'signal_strenth': [None if value == -1 else value for value in self._signal_strength],
+        }
+        for name, column in self._columns.iteritems():
+            _, unknown, _, decode = COLUMNS[name]
+            result[name] = [None if raw == unknown else decoded for raw, decoded in izip(column, map(decode, column))]
+        known, flags = self._flags_known, self._flags
+        for name, bit in FLAG_BITS.iteritems():
+            result[name] = [bool(value & bit) if known_bits & bit else None for known_bits, value in izip(known, flags)]
+        return result
+
+    def ages(self, now=None):
+        """Returns list of (sender_id, seconds since last update) of all states"""
+
+        now = time.time() if now is None else now
+        return [(sender_id, now - last_updated) for sender_id, last_updated in izip(self._sender_ids, self._last_updated)]
+
+    def save(self, path):
+        """Writes snapshot of all states to path, replacing it atomically"""
+
+        snapshot = {}
+        for sender_id, state in self.as_dict().items():
+            state['last_updated'] = state['last_updated'].strftime(DATETIME_FORMAT)
+            snapshot[sender_id] = state
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        """Loads snapshot written by save(), marking all loaded states as stale"""
+
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        for sender_id, state in snapshot.items():
+            last_updated = datetime.strptime(state.pop('last_updated'), DATETIME_FORMAT)
+            signal_strength = state.pop('signal_strenth', None)
+            state.pop('stale', None)
+            self.update(int(sender_id), state, signal_strength, last_updated)
+            self.mark_stale(int(sender_id))
+
+    def mark_stale(self, sender_id):
+        """Marks state of sender_id as stale until its next update"""
+
+        slot = self._slots[sender_id]
+        self._flags_known[slot] |= FLAG_BITS['stale']
+        self._flags[slot] |= FLAG_BITS['stale']
+
+    def get(self, sender_id, default=None):
+        if sender_id not in self._slots:
+            return default
+        return StateView(self, self._slots[sender_id])
+
+    def items(self):
+        return [(sender_id, StateView(self, slot)) for sender_id, slot in self._slots.items()]
+
+    def __getitem__(self, sender_id):
+        return StateView(self, self._slots[sender_id])
+
+    def __contains__(self, sender_id):
+        return sender_id in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+
+class StateView(Mapping):
+    """Read-only mapping of the current state of one device in ThermostatStates"""
+
+    __slots__ = ('_states', '_slot')
+
+    def __init__(self, states, slot):
+        self._states = states
+        self._slot = slot
+
+    def __getitem__(self, key):
+        return self._states._field(self._slot, key)
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return len(self.copy())
+
+    def copy(self):
+        return self._states._build((self._slot,))[0]
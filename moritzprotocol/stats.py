@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.stats
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Small runtime statistics helpers for latencies worth watching in production
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+from collections import deque
+import threading
+
+# environment imports
+
+# custom imports
+
+# local constants
+
+
+class LatencyStatistics(object):
+    """Keeps the last size durations (seconds) plus totals, reported in milliseconds"""
+
+    def __init__(self, size=100):
+        self._recent = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.maximum = 0.0
+
+    def add(self, duration):
+        with self._lock:
+            self._recent.append(duration)
+            self.count += 1
+            self.maximum = max(self.maximum, duration)
+
+    def as_dict(self):
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return {'count': self.count}
+        return {
+            'count': self.count,
+            'last_ms': round(self._recent[-1] * 1000, 3),
+            'median_ms': round(recent[len(recent) / 2] * 1000, 3),
+            'p95_ms': round(recent[int(len(recent) * 0.95)] * 1000, 3),
+            'max_ms': round(self.maximum * 1000, 3),
+        }
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.storage
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Storage backends for the state history of thermostats.
+
+    SegmentStorage is an append-only time series store: every device gets a directory of
+    segment files holding fixed-width records, each segment indexed by its first and last
+    timestamp so range queries only touch overlapping segments and binary search within them.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+import calendar
+from datetime import datetime
+import mmap
+import os
+import struct
+import threading
+
+# environment imports
+
+# custom imports
+from moritzprotocol.messages import MODE_IDS, MODES_BY_NAME
+
+# local constants
+# timestamp, measured temperature * 10, desired temperature * 2, valve position, mode,
+# signal strength, flags. Unknown values are stored as UNKNOWN_BYTE / UNKNOWN_MEASURED
+RECORD = struct.Struct("<dhBBBBBx")
+UNKNOWN_BYTE = 0xFF
+UNKNOWN_MEASURED = -0x8000
+FLAGS = ("dstsetting", "langateway", "is_locked", "rferror", "battery_low")
+SEGMENT_RECORDS = 0x10000
+
+
+def to_timestamp(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class StateStorage(object):
+    """Interface of state history backends"""
+
+    def store_state(self, sender_id, timestamp, state, changes):
+        """Stores state of sender_id at timestamp. state holds all known fields, changes the changed ones"""
+
+        raise NotImplementedError()
+
+    def query_states(self, sender_id, start, end):
+        """Returns list of state dicts of sender_id with start <= last_updated <= end, oldest first"""
+
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class Segment(object):
+    """One file of fixed-width records with its time range"""
+
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        self.count = size / RECORD.size
+        if size % RECORD.size:
+            # partially written record of an interrupted append
+            with open(path, "r+b") as segment_file:
+                segment_file.truncate(self.count * RECORD.size)
+        self.first = self.last = None
+        if self.count:
+            with open(path, "rb") as segment_file:
+                self.first = RECORD.unpack(segment_file.read(RECORD.size))[0]
+                segment_file.seek((self.count - 1) * RECORD.size)
+                self.last = RECORD.unpack(segment_file.read(RECORD.size))[0]
+
+    def overlaps(self, start, end):
+        return self.count and self.first <= end and self.last >= start
+
+
+class SegmentStorage(StateStorage):
+    """Append-only binary store, see module documentation. Naive timestamps are stored as epoch
+    seconds as if they were UTC, so they come back unchanged. They are kept monotonic per device
+    so segments stay sorted."""
+
+    def __init__(self, path, segment_records=SEGMENT_RECORDS):
+        self.path = path
+        self.segment_records = segment_records
+        self._segments = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for device_dir in os.listdir(path):
+            segment_names = sorted(os.listdir(os.path.join(path, device_dir)))
+            self._segments[int(device_dir, base=16)] = [
+                Segment(os.path.join(path, device_dir, name)) for name in segment_names]
+
+    def _append_file(self, sender_id):
+        """Returns file of current segment of sender_id, starting a new segment when full"""
+
+        segments = self._segments.setdefault(sender_id, [])
+        if not segments or segments[-1].count >= self.segment_records:
+            if sender_id in self._files:
+                self._files.pop(sender_id).close()
+            device_dir = os.path.join(self.path, "%06X" % sender_id)
+            if not os.path.isdir(device_dir):
+                os.makedirs(device_dir)
+            segment_path = os.path.join(device_dir, "%08i.seg" % len(segments))
+            open(segment_path, "ab").close()
+            segments.append(Segment(segment_path))
+        if sender_id not in self._files:
+            self._files[sender_id] = open(segments[-1].path, "ab")
+        return self._files[sender_id]
+
+    @staticmethod
+    def encode_record(timestamp, state):
+        flags = 0
+        for bit, name in enumerate(FLAGS):
+            if state.get(name):
+                flags |= 1 << bit
+        measured = state.get('measured_temperature')
+        desired = state.get('desired_temperature')
+        # a StateView returns None for unknown signal strength instead of leaving it out
+        signal_strength = state.get('signal_strenth')
+        return RECORD.pack(
+            timestamp,
+            int(round(measured * 10)) if measured is not None else UNKNOWN_MEASURED,
+            int(desired * 2) if desired is not None else UNKNOWN_BYTE,
+            state.get('valve_position', UNKNOWN_BYTE),
+            MODES_BY_NAME.get(state.get('mode'), UNKNOWN_BYTE),
+            signal_strength if signal_strength is not None else UNKNOWN_BYTE,
+            flags,
+        )
+
+    @staticmethod
+    def decode_record(record):
+        timestamp, measured, desired, valve_position, mode, signal_strength, flags = RECORD.unpack(record)
+        state = {'last_updated': datetime.utcfromtimestamp(timestamp)}
+        if measured != UNKNOWN_MEASURED:
+            state['measured_temperature'] = measured / 10.0
+        if desired != UNKNOWN_BYTE:
+            state['desired_temperature'] = desired / 2.0
+        if valve_position != UNKNOWN_BYTE:
+            state['valve_position'] = valve_position
+        if mode != UNKNOWN_BYTE:
+            state['mode'] = MODE_IDS[mode]
+        if signal_strength != UNKNOWN_BYTE:
+            state['signal_strength'] = signal_strength
+        for bit, name in enumerate(FLAGS):
+            state[name] = bool(flags & (1 << bit))
+        return state
+
+    def store_state(self, sender_id, timestamp, state, changes):
+        with self._lock:
+            append_file = self._append_file(sender_id)
+            segment = self._segments[sender_id][-1]
+            timestamp = to_timestamp(timestamp)
+            if segment.last is not None and timestamp < segment.last:
+                # clock went backwards, keep segment sorted
+                timestamp = segment.last
+            append_file.write(self.encode_record(timestamp, state))
+            append_file.flush()
+            if segment.first is None:
+                segment.first = timestamp
+            segment.last = timestamp
+            segment.count += 1
+
+    def query_states(self, sender_id, start, end):
+        start, end = to_timestamp(start), to_timestamp(end)
+        with self._lock:
+            segments = [(segment.path, segment.count) for segment in self._segments.get(sender_id, [])
+                        if segment.overlaps(start, end)]
+        result = []
+        for path, count in segments:
+            with open(path, "rb") as segment_file:
+                mapped = mmap.mmap(segment_file.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+            try:
+                # binary search for first record at or after start
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) / 2
+                    if struct.unpack_from("<d", mapped, middle * RECORD.size)[0] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+                for index in xrange(low, count):
+                    offset = index * RECORD.size
+                    if struct.unpack_from("<d", mapped, offset)[0] > end:
+                        break
+                    result.append(self.decode_record(mapped[offset:offset + RECORD.size]))
+            finally:
+                mapped.close()
+        return result
+
+    def close(self):
+        with self._lock:
+            for append_file in self._files.values():
+                append_file.close()
+            self._files = {}
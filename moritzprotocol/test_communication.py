@@ -0,0 +1,351 @@
+import gc
+import os
+import Queue
+import shutil
+import tempfile
+import time
+import unittest
+from .communication import *
+from .exceptions import QueueFullError
+from .messages import *
+from .queues import BoundedQueue
+from .signals import device_pair_request, thermostatstate_received
+from .states import to_epoch
+
+
+class MessageDispatchTestCase(unittest.TestCase):
+	def setUp(self):
+		self.thread = CULMessageThread(Queue.Queue(), "/dev/null")
+
+	def test_thermostat_state_updates_states(self):
+		msg = MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA")
+		self.thread.respond_to_message(msg, 0x20)
+		self.assertEqual(self.thread.thermostat_states[0x8FFE9]['valve_position'], 0)
+		self.assertEqual(self.thread.thermostat_states[0x8FFE9]['signal_strenth'], 0x20)
+
+	def test_received_frame_shares_timestamp(self):
+		self.thread.process_frame("Z0F61046008FFE90000000019002000CA2A")
+		state = self.thread.thermostat_states[0x8FFE9]
+		self.assertEqual(state['signal_strenth'], 0x2A)
+		self.assertEqual(state['measured_temperature'], 20.2)
+		self.assertAlmostEqual(to_epoch(state['last_updated']), self.thread.link_quality[0x8FFE9].last_heard, places=5)
+		# relayed copy is dropped before decoding
+		self.thread.process_frame("Z0F61006008FFE90000000019002000CA1C")
+		self.assertEqual(self.thread.duplicate_filter.hits, 1)
+
+	def test_unchanged_thermostat_state_is_not_signalled(self):
+		received = []
+		def receiver(sender, **kw):
+			received.append(kw['changes'])
+		thermostatstate_received.connect(receiver)
+		try:
+			for signal_strength in (0x20, 0x21):
+				msg = MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA")
+				self.thread.respond_to_message(msg, signal_strength)
+		finally:
+			thermostatstate_received.disconnect(receiver)
+		self.assertEqual(len(received), 1)
+		self.assertEqual(received[0]['measured_temperature'], 20.2)
+		self.assertEqual(self.thread.thermostat_states[0x8FFE9]['signal_strenth'], 0x21)
+
+	def test_unacknowledged_command_is_retried_when_device_is_heard(self):
+		msg = SetTemperatureMessage()
+		msg.counter = 0xB9
+		msg.sender_id = CUBE_ID
+		msg.receiver_id = 0x8FFE9
+		self.thread._process_command(msg, {'desired_temperature': 20.0, 'mode': 'manual'})
+		self.assertEqual(self.thread.com_send_queue.get_nowait(), "Zs0BB9004012345608FFE90068")
+		key = (0x8FFE9, 0xB9)
+		self.thread._awaiting_ack[key] = self.thread._awaiting_ack[key][:2] + (0, 0)
+		self.thread._check_awaiting_acks()
+		self.thread._send_deferred()
+		self.assertTrue(self.thread.com_send_queue.empty())
+
+		self.thread.link_quality[0x8FFE9].heard(0x20)
+		self.thread._release_held(0x8FFE9)
+		self.assertEqual(self.thread.com_send_queue.get_nowait(), "Zs0BB9004012345608FFE90068")
+		self.assertEqual(self.thread.link_quality[0x8FFE9].retries, 1)
+
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0EB9020208FFE9123456000119000B"), 0x20)
+		self.assertEqual(self.thread._awaiting_ack, {})
+		self.assertEqual(self.thread.link_quality[0x8FFE9].ack_rate, 0.5)
+
+	def test_commands_to_sleeping_thermostat_are_held(self):
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		msg = SetTemperatureMessage()
+		msg.counter = 0xB9
+		msg.sender_id = CUBE_ID
+		msg.receiver_id = 0x8FFE9
+		self.thread._process_command(msg, {'desired_temperature': 20.0, 'mode': 'manual'})
+		self.assertTrue(self.thread.com_send_queue.empty())
+		self.thread._release_held(0x8FFE9)
+		self.assertEqual(self.thread.com_send_queue.get_nowait(), "Zs0BB9004012345608FFE90068")
+
+		self.thread._process_command(msg, {'desired_temperature': 20.0, 'mode': 'manual'}, urgent=True)
+		self.assertEqual(self.thread.com_send_queue.get_nowait()[8:10], "F1")
+		self.assertEqual(self.thread.com_send_queue.get_nowait(), "Zs0BB9004012345608FFE90068")
+
+	def test_urgent_command_waits_for_room_of_wakeup_and_command(self):
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		for _ in range(self.thread.com_send_queue.maxsize - 1):
+			self.thread.com_send_queue.put("Zs")
+		msg = SetTemperatureMessage()
+		msg.counter = 0xB9
+		msg.sender_id = CUBE_ID
+		msg.receiver_id = 0x8FFE9
+		self.thread._process_command(msg, {'desired_temperature': 20.0, 'mode': 'manual'}, urgent=True)
+		self.assertEqual(self.thread.com_send_queue.qsize(), self.thread.com_send_queue.maxsize - 1)
+		while not self.thread.com_send_queue.empty():
+			self.thread.com_send_queue.get_nowait()
+		self.thread._check_held()
+		self.assertEqual(self.thread.com_send_queue.get_nowait()[8:10], "F1")
+		self.assertEqual(self.thread.com_send_queue.get_nowait(), "Zs0BB9004012345608FFE90068")
+
+	def test_held_commands_coalesce(self):
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		for temperature in range(25):
+			msg = SetTemperatureMessage()
+			msg.counter = temperature + 1
+			msg.sender_id = CUBE_ID
+			msg.receiver_id = 0x8FFE9
+			self.thread._process_command(msg, {'desired_temperature': temperature, 'mode': 'manual'})
+		self.assertEqual(len(self.thread._held[0x8FFE9]), 1)
+		self.assertEqual(self.thread._held[0x8FFE9][0][1]['desired_temperature'], 24)
+
+	def test_held_commands_are_limited_per_device(self):
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		for part in range(MAX_HELD_PER_DEVICE + 2):
+			msg = ConfigWeekProfileMessage()
+			msg.counter = part + 1
+			msg.sender_id = CUBE_ID
+			msg.receiver_id = 0x8FFE9
+			self.thread._process_command(msg, {'day': 'monday', 'part': part, 'entries': []})
+		held = self.thread._held[0x8FFE9]
+		self.assertEqual(len(held), MAX_HELD_PER_DEVICE)
+		self.assertEqual(held[0][1]['part'], 2)
+
+	def test_more_held_commands_than_send_queue_takes(self):
+		thread = CULMessageThread(Queue.Queue(), "/dev/null", send_queue_size=5)
+		thread.process_frame("Z0F61046008FFE90000000019002000CA2A")
+		thread.link_quality[0x8FFE9].last_heard -= AWAKE_WINDOW + 1
+		for part in range(8):
+			msg = ConfigWeekProfileMessage()
+			msg.counter = part + 1
+			msg.sender_id = CUBE_ID
+			msg.receiver_id = 0x8FFE9
+			thread._process_command(msg, {'day': 'monday', 'part': part, 'entries': [(1440, 17.0)]})
+		self.assertTrue(thread.com_send_queue.empty())
+		thread.process_frame("Z0F62046008FFE90000000019002000CA2A")
+		self.assertEqual(thread.com_send_queue.qsize(), 5)
+		self.assertEqual(len(thread._held[0x8FFE9]), 3)
+		while not thread.com_send_queue.empty():
+			thread.com_send_queue.get_nowait()
+		thread.process_frame("Z0F63046008FFE90000000019002000CA2A")
+		self.assertEqual(thread.com_send_queue.qsize(), 3)
+		self.assertNotIn(0x8FFE9, thread._held)
+
+	def test_week_profile_is_queued_completely_or_not_at_all(self):
+		self.thread.command_queue = BoundedQueue(3, "reject")
+		self.thread.command_queue.put((SetTemperatureMessage(), {}))
+		profile = {
+			'monday': [("06:00", 17), ("24:00", 21)],
+			'tuesday': [("%02i:00" % hour, 17) for hour in range(1, 24)[::2]] + [("24:00", 21)],
+		}
+		with self.assertRaises(QueueFullError):
+			self.thread.set_week_profile(0x8FFE9, profile)
+		self.assertEqual(self.thread.command_queue.qsize(), 1)
+		self.thread.command_queue.get_nowait()
+		self.assertEqual(self.thread.set_week_profile(0x8FFE9, profile), 3)
+		self.assertEqual(self.thread.command_queue.qsize(), 3)
+
+	def test_pair_pong_is_sent_before_signalling(self):
+		sent_before_signal = []
+		def receiver(sender, **kw):
+			sent_before_signal.append(not self.thread.com_send_queue.empty())
+		device_pair_request.connect(receiver)
+		self.thread.com_thread._pending_budget = 5000
+		try:
+			self.thread.respond_to_message(MoritzMessage.decode_message("Z170004000E016C000000001001A04B455130393932343736"), 0x20)
+		finally:
+			device_pair_request.disconnect(receiver)
+		self.assertEqual(sent_before_signal, [True])
+		self.assertTrue(self.thread.command_queue.empty())
+		self.assertEqual(MoritzMessage.decode_message("Z" + self.thread.com_send_queue.get_nowait()[2:]).receiver_id, 0xE016C)
+		self.assertEqual(self.thread.pair_response_latency.count, 1)
+		# answers with fixed counter are neither retried nor counted for link quality
+		self.assertEqual(self.thread._awaiting_ack, {})
+		self.assertNotIn(0xE016C, self.thread.link_quality)
+
+	def test_custom_handler(self):
+		received = []
+		self.thread.register_message_handler(WakeUpMessage, lambda msg, signal_strength: received.append(msg))
+		msg = MoritzMessage.decode_message("Z0AB900F11234560B355400")
+		self.thread.respond_to_message(msg, 0x20)
+		self.assertEqual(received, [msg])
+		self.assertEqual(self.thread.unhandled_messages, 0)
+
+	def test_unhandled_message_is_counted(self):
+		msg = MoritzMessage.decode_message("Z0AB900F11234560B355400")
+		self.thread.respond_to_message(msg, 0x20)
+		self.assertEqual(self.thread.unhandled_messages, 1)
+
+	def test_register_unknown_message_id(self):
+		with self.assertRaises(UnknownMessageError):
+			self.thread.register_message_handler(0xEE, lambda msg, signal_strength: None)
+
+
+class StateSnapshotTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.snapshot_path = os.path.join(self.tmp_dir, "states.json")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_restore_marks_states_stale(self):
+		thread = CULMessageThread(Queue.Queue(), "/dev/null", state_snapshot_path=self.snapshot_path)
+		thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		thread.save_state_snapshot()
+
+		restored = CULMessageThread(Queue.Queue(), "/dev/null", state_snapshot_path=self.snapshot_path)
+		state = restored.thermostat_states[0x8FFE9]
+		self.assertTrue(state['stale'])
+		self.assertEqual(state['measured_temperature'], 20.2)
+		self.assertEqual(state['last_updated'], thread.thermostat_states[0x8FFE9]['last_updated'])
+
+		restored.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		self.assertFalse('stale' in restored.thermostat_states[0x8FFE9])
+
+
+class FrameFilterTestCase(unittest.TestCase):
+	def test_own_traffic_only(self):
+		frame_filter = FrameFilter(receiver_ranges=[(CUBE_ID, CUBE_ID)], known_devices=[0x8FFE9],
+			always_accepted_types=[MORITZ_MESSAGE_TYPES[PairPingMessage]])
+		# state broadcast of known device
+		self.assertTrue(frame_filter.accepts("Z0F61046008FFE90000000019002000CA2A"))
+		# ack to us
+		self.assertTrue(frame_filter.accepts("Z0EB902020B3554123456000119000B2A"))
+		# pairing of new device
+		self.assertTrue(frame_filter.accepts("Z170004000E016C000000001001A04B4551303939323437362A"))
+		# neighbour sending to his cube
+		self.assertFalse(frame_filter.accepts("Z0EB902020B3554654321000119000B2A"))
+		self.assertEqual(frame_filter.accepted, 3)
+		self.assertEqual(frame_filter.filtered['address'], 1)
+
+	def test_message_type_allow_list(self):
+		frame_filter = FrameFilter(message_types=[MORITZ_MESSAGE_TYPES[AckMessage]])
+		self.assertTrue(frame_filter.accepts("Z0EB902020B3554654321000119000B2A"))
+		self.assertFalse(frame_filter.accepts("Z0F61046008FFE90000000019002000CA2A"))
+		self.assertEqual(frame_filter.filtered['message_type'], 1)
+
+	def test_malformed_frames_are_dropped(self):
+		frame_filter = FrameFilter(known_devices=[1])
+		self.assertFalse(frame_filter.accepts("Zxx"))
+		self.assertFalse(frame_filter.accepts("Z0B"))
+		self.assertFalse(frame_filter.accepts("Z0F61046008FFXX0000000019002000CA2A"))
+		self.assertEqual(frame_filter.filtered['malformed'], 3)
+
+
+class DuplicateFrameFilterTestCase(unittest.TestCase):
+	def test_duplicates_within_window(self):
+		frame_filter = DuplicateFrameFilter(window=1.0)
+		self.assertFalse(frame_filter.is_duplicate("Z0F61046008FFE90000000019002000CA2A", now=10.0))
+		# relayed copy with different flag and signal strength
+		self.assertTrue(frame_filter.is_duplicate("Z0F61006008FFE90000000019002000CA1C", now=10.5))
+		self.assertFalse(frame_filter.is_duplicate("Z0F62046008FFE90000000019002000CA2A", now=10.5))
+		self.assertFalse(frame_filter.is_duplicate("Z0F61046008FFE90000000019002000CA2A", now=11.2))
+		self.assertEqual(frame_filter.lookups, 4)
+		self.assertEqual(frame_filter.hit_rate, 0.25)
+
+
+class FrameDecodingAllocationTestCase(unittest.TestCase):
+	def setUp(self):
+		# state changes get logged for each frame, records would count as allocations
+		self.logger_disabled = message_logger.disabled
+		message_logger.disabled = True
+		self.thread = CULMessageThread(Queue.Queue(), "/dev/null")
+		self.thread.duplicate_filter.window = 0
+
+	def tearDown(self):
+		message_logger.disabled = self.logger_disabled
+
+	def state_frames(self, count, devices=20):
+		return ["Z0F%02X0460%06X%06X000C%02X2A%04X30" % (
+			index / devices % 0x100, 0x100000 + index % devices, CUBE_ID, index % 101, 180 + index % 50)
+			for index in xrange(count)]
+
+	def test_decoding_retains_no_objects_per_frame(self):
+		# first frame of each device creates its state slot and link quality entry
+		for frame in self.state_frames(20):
+			self.thread.process_frame(frame)
+		frames = self.state_frames(2000)
+		gc.collect()
+		gc.disable()
+		try:
+			objects_before = len(gc.get_objects())
+			for frame in frames:
+				self.thread.process_frame(frame)
+			retained = len(gc.get_objects()) - objects_before
+		finally:
+			gc.enable()
+		self.assertEqual(len(self.thread.thermostat_states), 20)
+		self.assertLess(retained, len(frames) / 20)
+
+
+class FakeSerial(object):
+	"""Answers version and budget requests like a CUL, fails on the first write if fail_once is set"""
+	fail_once = False
+	written = []
+
+	def __init__(self, device_path):
+		self.output = []
+
+	def write(self, data):
+		if FakeSerial.fail_once and data.startswith("Zs"):
+			FakeSerial.fail_once = False
+			raise IOError("device disconnected")
+		FakeSerial.written.append(data.strip())
+		if data.startswith("V"):
+			self.output.extend("V 1.61 CUL868\r\n")
+		elif data.startswith("X\r"):
+			self.output.extend("21  900\r\n")
+
+	def inWaiting(self):
+		return len(self.output)
+
+	def read(self, size):
+		return self.output.pop(0)
+
+	def close(self):
+		pass
+
+
+class TransportSupervisionTestCase(unittest.TestCase):
+	def test_reconnect_keeps_pending_message(self):
+		FakeSerial.fail_once = True
+		FakeSerial.written = []
+		send_queue = Queue.Queue()
+		send_queue.put("Zs0BB900401234560B3554004B")
+		com_thread = CULComThread(send_queue, Queue.Queue(), "/dev/null", serial_factory=FakeSerial)
+		com_thread.start()
+		try:
+			deadline = time.time() + 5
+			while "Zs0BB900401234560B3554004B" not in FakeSerial.written and time.time() < deadline:
+				time.sleep(0.05)
+		finally:
+			com_thread.join()
+		self.assertEqual(com_thread.reconnects, 1)
+		self.assertTrue("Zs0BB900401234560B3554004B" in FakeSerial.written)
+
+
+	def test_all_received_frames_are_processed_per_loop(self):
+		thread = CULMessageThread(Queue.Queue(), "/dev/null", serial_factory=FakeSerial)
+		for sender_id in range(0x100, 0x10A):
+			thread.com_receive_queue.put("Z0F610460%06X0000000019002000CA2A" % sender_id)
+		thread.start()
+		try:
+			# less than one loop of the thread
+			time.sleep(0.2)
+			self.assertEqual(len(thread.thermostat_states), 10)
+		finally:
+			thread.join()
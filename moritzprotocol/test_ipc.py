@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from .exceptions import QueueFullError
+from .ipc import *
+from .states import ThermostatStates
+
+
+class SharedStateTableTestCase(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_reader_sees_published_states(self):
+		path = os.path.join(self.path, "states.shm")
+		writer = SharedStateTable(path, slots=2, writer=True)
+		reader = SharedStateTable(path)
+		self.assertEqual(reader.as_dict(), {})
+		last_updated = datetime(2014, 12, 1, 10, 30)
+		writer.publish(0x8FFE9, {'last_updated': last_updated, 'valve_position': 10, 'signal_strenth': 0x20})
+		writer.publish(0x8FFE9, {'last_updated': last_updated, 'valve_position': 20, 'signal_strenth': 0x20})
+		writer.publish(0x123, {'last_updated': last_updated, 'mode': 'auto'})
+		writer.publish(0x456, {'last_updated': last_updated})
+		states = reader.as_dict()
+		self.assertEqual(sorted(states), [0x123, 0x8FFE9])
+		self.assertEqual(states[0x8FFE9]['valve_position'], 20)
+		self.assertEqual(states[0x8FFE9]['signal_strenth'], 0x20)
+		self.assertEqual(states[0x8FFE9]['last_updated'], last_updated)
+		self.assertEqual(states[0x123]['mode'], 'auto')
+		reader.close()
+		writer.close()
+
+	def test_state_without_signal_strength(self):
+		path = os.path.join(self.path, "states.shm")
+		writer = SharedStateTable(path, slots=1, writer=True)
+		states = ThermostatStates()
+		states.update(0x123, {'valve_position': 10}, None, datetime(2014, 12, 1, 10, 30))
+		writer.publish(0x123, states[0x123])
+		state = SharedStateTable(path).as_dict()[0x123]
+		self.assertEqual(state['valve_position'], 10)
+		self.assertNotIn('signal_strenth', state)
+		writer.close()
+
+	def test_stale_states_are_marked(self):
+		path = os.path.join(self.path, "states.shm")
+		writer = SharedStateTable(path, slots=2, writer=True)
+		reader = SharedStateTable(path)
+		last_updated = datetime(2014, 12, 1, 10, 30)
+		writer.publish(0x123, {'last_updated': last_updated, 'mode': 'auto', 'stale': True})
+		writer.publish(0x456, {'last_updated': last_updated, 'mode': 'auto'})
+		states = reader.as_dict()
+		self.assertTrue(states[0x123]['stale'])
+		self.assertNotIn('stale', states[0x456])
+		self.assertEqual(reader.as_columns()['stale'], [True, None])
+		reader.close()
+		writer.close()
+
+	def test_slot_written_forever_returns_last_record(self):
+		path = os.path.join(self.path, "states.shm")
+		writer = SharedStateTable(path, slots=1, writer=True)
+		reader = SharedStateTable(path)
+		last_updated = datetime(2014, 12, 1, 10, 30)
+		writer.publish(0x123, {'last_updated': last_updated, 'valve_position': 10})
+		self.assertEqual(reader.as_dict()[0x123]['valve_position'], 10)
+		writer.publish(0x123, {'last_updated': last_updated, 'valve_position': 20})
+		# writer died halfway through an update, leaving the sequence odd
+		SLOT_HEADER.pack_into(writer._mapped, HEADER.size, 0x123, 5, False)
+		self.assertEqual(reader.as_dict()[0x123]['valve_position'], 10)
+		self.assertRaises(IOError, SharedStateTable(path).as_dict)
+		reader.close()
+		writer.close()
+
+
+class Target(object):
+	def add(self, a, b):
+		return a + b
+
+	def full(self):
+		raise QueueFullError("full")
+
+
+class RadioClientTestCase(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		address = os.path.join(self.path, "radio.sock")
+		self.listener = RadioListener(address, "secret", Target(), ("add", "full"))
+		self.listener.start()
+		self.client = RadioClient(address, "secret")
+
+	def tearDown(self):
+		self.listener.close()
+		shutil.rmtree(self.path)
+
+	def test_calls(self):
+		self.assertEqual(self.client.add(1, 2), 3)
+		with self.assertRaises(QueueFullError):
+			self.client.full()
+		with self.assertRaises(AttributeError):
+			self.client.call("__init__")
+		self.assertEqual(self.client.call("add", "a", "b"), "ab")
@@ -1,5 +1,11 @@
 from datetime import datetime
+import struct
 import unittest
+try:
+	import numpy
+except ImportError:
+	numpy = None
+from .exceptions import InvalidFrameError, LengthNotMatchingError
 from .messages import *
 
 
@@ -26,6 +32,17 @@ class MessageSampleInputTestCase(unittest.TestCase):
 			'valve_position': 0
 		})
 
+	def test_received_frame(self):
+		msg, signal_strength = MoritzMessage.decode_frame("Z0F61046008FFE90000000019002000CA2A")
+		self.assertEqual(signal_strength, 0x2A)
+		self.assertEqual(msg.sender_id, 0x8FFE9)
+		self.assertEqual(msg.payload, '19002000CA')
+		self.assertEqual(msg.decoded_payload, MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA").decoded_payload)
+		with self.assertRaises(LengthNotMatchingError):
+			MoritzMessage.decode_frame("Z0F61046008FFE90000000019002000CA")
+		with self.assertRaises(InvalidFrameError):
+			MoritzMessage.decode_frame("Z0F61046008FFE900000000190020XXCA2A")
+
 	def test_set_temperature(self):
 		sample = "Z0BB900401234560B3554004B"
 		msg = MoritzMessage.decode_message(sample)
@@ -179,3 +196,78 @@ class MessageOutputSampleTestCase(unittest.TestCase):
 		msg.group_id = 0x0
 		payload = datetime(2014, 12, 1, 2, 33, 23)
 		self.assertEqual(msg.encode_message(payload=payload), "Zs0F0204031234560E016C000E0102E117")
+
+	def test_wake_up(self):
+		msg = WakeUpMessage()
+		msg.counter = 0xB9
+		msg.sender_id = 0x123456
+		msg.receiver_id = 0x0B3554
+		msg.group_id = 0
+		self.assertEqual(msg.encode_message(payload={'duration': 0x3F}), "Zs0BB900F11234560B3554003F")
+
+	def test_set_week_profile(self):
+		msg = ConfigWeekProfileMessage()
+		msg.counter = 0x02
+		msg.sender_id = 0x123456
+		msg.receiver_id = 0xE016C
+		msg.group_id = 0x0
+		payload = {
+			'day': 'monday',
+			'part': 0,
+			'entries': [(360, 17.0), (1320, 21.0), (1440, 17.0)],
+		}
+		encoded_message = msg.encode_message(payload=payload)
+		self.assertEqual(encoded_message, "Zs110200101234560E016C0002444855084520")
+		decoded = MoritzMessage.decode_message(encoded_message)
+		self.assertEqual(decoded.decoded_payload, payload)
+
+
+@unittest.skipIf(numpy is None, "numpy not installed")
+class BulkDecodeTestCase(unittest.TestCase):
+	samples = [
+		"Z0F61046008FFE90000000019002000CA",
+		"Z0F61046008FFE9000000009A002000CA",
+		"Z0EB902020B3554123456000119000B",
+		"Z0E61046008FFE9000000001900200",
+		"Z0F61046008FFE9000000001A0020XXCA",
+	]
+
+	def test_matches_single_decoder(self):
+		result = decode_messages_bulk(sample + "2A" for sample in self.samples)
+		self.assertEqual(list(result['valid']), [True, True, True, False, False])
+		for row, sample in enumerate(self.samples[:3]):
+			msg = MoritzMessage.decode_message(sample)
+			self.assertEqual(result['msgtype'][row], MORITZ_MESSAGE_TYPES[msg.__class__])
+			self.assertEqual(result['sender_id'][row], msg.sender_id)
+			self.assertEqual(result['receiver_id'][row], msg.receiver_id)
+			self.assertEqual(result['counter'][row], msg.counter)
+			self.assertEqual(result['signal_strength'][row], 0x2A)
+			if isinstance(msg, ThermostatStateMessage):
+				decoded = msg.decoded_payload
+				for field in ("valve_position", "desired_temperature", "dstsetting", "langateway", "is_locked", "rferror", "battery_low"):
+					self.assertEqual(result[field][row], decoded[field])
+				self.assertEqual(MODE_IDS[result['mode'][row]], decoded['mode'])
+				if 'measured_temperature' in decoded:
+					self.assertAlmostEqual(result['measured_temperature'][row], decoded['measured_temperature'], places=5)
+				else:
+					self.assertTrue(numpy.isnan(result['measured_temperature'][row]))
+
+	def test_chunks_and_empty_input(self):
+		result = decode_messages_bulk([self.samples[0]] * 5, with_signal_strength=False, chunk_size=2)
+		self.assertEqual(len(result), 5)
+		self.assertTrue(result['valid'].all())
+		self.assertEqual(len(decode_messages_bulk([])), 0)
+
+	def test_short_state_is_invalid(self):
+		result = decode_messages_bulk(["Z0B0A046008FFE912345600192A", "Z0F61046008FFE90000000019002000CA2A"])
+		self.assertEqual(list(result['valid']), [False, True])
+		with self.assertRaises(struct.error):
+			MoritzMessage.decode_message("Z0B0A046008FFE912345600192A"[:-2]).decoded_payload
+
+	def test_outgoing_lines_have_no_signal_strength(self):
+		result = decode_messages_bulk(["Zs0BB9004012345608FFE90068", "Z0F61046008FFE90000000019002000CA2A"])
+		self.assertEqual(list(result['valid']), [True, True])
+		self.assertEqual(result['receiver_id'][0], 0x8FFE9)
+		self.assertEqual(result['desired_temperature'][0], 0)
+		self.assertEqual(result['signal_strength'][1], 0x2A)
+
@@ -0,0 +1,44 @@
+import Queue
+import unittest
+from .communication import CULMessageThread
+from .messages import *
+from .polling import *
+
+
+class StatePollerTestCase(unittest.TestCase):
+	def setUp(self):
+		self.thread = CULMessageThread(Queue.Queue(), "/dev/null")
+		self.thread.com_thread.send_budget = 20000
+		self.poller = StatePoller(self.thread, interval=60, min_age=1800)
+		self.thread.thermostat_states.update(0x1, {'mode': 'auto'}, 0x20, 1000.0)
+		self.thread.thermostat_states.update(0x2, {'mode': 'auto'}, 0x20, 2000.0)
+		self.thread.thermostat_states.update(0x3, {'mode': 'auto'}, 0x20, 9000.0)
+
+	def polled(self):
+		return MoritzMessage.decode_message("Z" + self.thread.com_send_queue.get_nowait()[2:])
+
+	def test_stalest_device_first_then_round_robin(self):
+		self.assertEqual(self.poller.poll(now=10000.0), 0x1)
+		msg = self.polled()
+		self.assertTrue(isinstance(msg, WakeUpMessage))
+		self.assertEqual(msg.receiver_id, 0x1)
+		# not before interval passed
+		self.assertEqual(self.poller.poll(now=10030.0), None)
+		self.assertEqual(self.poller.poll(now=10060.0), 0x2)
+		self.polled()
+		# 0x3 is not stale enough yet, 0x1 was polled recently
+		self.assertEqual(self.poller.poll(now=10120.0), None)
+		self.assertEqual(self.poller.poll(now=12000.0), 0x3)
+		self.polled()
+		self.assertEqual(self.poller.poll(now=12060.0), 0x1)
+		self.assertEqual(self.poller.polls, 4)
+
+	def test_commands_and_budget_come_first(self):
+		self.thread.command_queue.put((WakeUpMessage(), {}))
+		self.assertEqual(self.poller.poll(now=10000.0), None)
+		self.assertEqual(self.poller.skipped_busy, 1)
+		self.thread.command_queue.get_nowait()
+		self.thread.com_thread.send_budget = 5000
+		self.assertEqual(self.poller.poll(now=10060.0), None)
+		self.assertEqual(self.poller.skipped_budget, 1)
+		self.assertTrue(self.thread.com_send_queue.empty())
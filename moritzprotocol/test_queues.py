@@ -0,0 +1,61 @@
+import unittest
+from .queues import *
+from .exceptions import QueueFullError
+from .messages import SetTemperatureMessage, ConfigWeekProfileMessage
+
+
+def command(msg_class, receiver_id, payload=None):
+	msg = msg_class()
+	msg.receiver_id = receiver_id
+	return (msg, payload)
+
+
+class BoundedQueueTestCase(unittest.TestCase):
+	def test_reject(self):
+		queue = BoundedQueue(2, "reject")
+		queue.put(1)
+		queue.put(2)
+		with self.assertRaises(QueueFullError):
+			queue.put(3)
+		self.assertEqual((queue.get(), queue.get()), (1, 2))
+		self.assertEqual(queue.rejected, 1)
+
+	def test_drop_oldest(self):
+		queue = BoundedQueue(2, "drop_oldest")
+		for item in (1, 2, 3):
+			queue.put(item)
+		self.assertEqual((queue.get(), queue.get()), (2, 3))
+		self.assertEqual(queue.dropped, 1)
+
+	def test_coalesce(self):
+		queue = BoundedQueue(2, "coalesce")
+		first = command(SetTemperatureMessage, 1, {'desired_temperature': 20})
+		newer = command(SetTemperatureMessage, 1, {'desired_temperature': 21})
+		queue.put(first)
+		queue.put(command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 0}))
+		queue.put(newer)
+		self.assertEqual(queue.qsize(), 2)
+		self.assertTrue(queue.get() is newer)
+		queue.put(command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 1}))
+		with self.assertRaises(QueueFullError):
+			queue.put(command(SetTemperatureMessage, 2))
+
+	def test_put_all_or_nothing(self):
+		queue = BoundedQueue(3, "reject")
+		queue.put(1)
+		with self.assertRaises(QueueFullError):
+			queue.put_all([2, 3, 4])
+		self.assertEqual(queue.qsize(), 1)
+		queue.put_all([2, 3])
+		self.assertEqual([queue.get() for _ in range(3)], [1, 2, 3])
+
+	def test_put_all_counts_coalesced_items(self):
+		queue = BoundedQueue(2, "coalesce")
+		queue.put(command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 0}))
+		queue.put_all([command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 0}),
+			command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 1})])
+		self.assertEqual((queue.qsize(), queue.coalesced), (2, 1))
+		with self.assertRaises(QueueFullError):
+			queue.put_all([command(ConfigWeekProfileMessage, 1, {'day': 'monday', 'part': 1}),
+				command(ConfigWeekProfileMessage, 1, {'day': 'tuesday', 'part': 0})])
+		self.assertEqual(queue.coalesced, 1)
@@ -0,0 +1,42 @@
+import Queue
+import unittest
+from .communication import CULMessageThread
+from .messages import MoritzMessage
+from .rules import *
+
+
+class RuleEngineTestCase(unittest.TestCase):
+	def setUp(self):
+		self.thread = CULMessageThread(Queue.Queue(), "/dev/null")
+		self.engine = RuleEngine(self.thread, [Rule.from_dict({
+			'name': "warm",
+			'device': "08FFE9",
+			'field': "measured_temperature",
+			'op': ">=",
+			'value': 20,
+			'then': {'receivers': ["123", "456"], 'desired_temperature': 17},
+		})])
+
+	def tearDown(self):
+		thermostatstate_received.disconnect(self.engine._state_changed)
+
+	def test_fires_once_on_becoming_true(self):
+		for temperature in (19.5, 20.2, 21.0, 19.0, 20.5):
+			self.engine.evaluate(0x8FFE9, {'measured_temperature': temperature})
+		self.engine.evaluate(0x1, {'measured_temperature': 25})
+		self.assertEqual(self.engine.rules[0].fired, 2)
+		self.assertEqual(self.thread.command_queue.qsize(), 4)
+		msg, payload, urgent = self.thread.command_queue.get_nowait()
+		self.assertEqual(msg.receiver_id, 0x123)
+		self.assertEqual(payload, {'desired_temperature': 17.0, 'mode': 'manual'})
+		self.assertEqual(self.engine.evaluation_time.count, 6)
+
+	def test_subscribed_to_state_changes(self):
+		self.thread.respond_to_message(MoritzMessage.decode_message("Z0F61046008FFE90000000019002000CA"), 0x20)
+		self.assertEqual(self.engine.rules[0].fired, 1)
+
+	def test_invalid_rule(self):
+		with self.assertRaises(InvalidRuleError):
+			Rule.from_dict({'field': "mode", 'op': "~", 'value': "auto", 'then': {'receivers': "sender", 'desired_temperature': 17}})
+		with self.assertRaises(InvalidRuleError):
+			Rule.from_dict({'field': "mode", 'value': "auto", 'then': {'receivers': "sender"}})
@@ -0,0 +1,49 @@
+import unittest
+from .communication import CUBE_ID
+from .messages import *
+from .simulation import *
+
+
+def read_line(cul):
+	line = ""
+	while cul.inWaiting() and not line.endswith("\n"):
+		line += cul.read(1)
+	return line
+
+
+class SimulatedCULTestCase(unittest.TestCase):
+	def setUp(self):
+		self.cul = SimulatedCUL([0x100000], report_interval=3600, ack_delay=0).open("simulated")
+
+	def test_version_and_budget(self):
+		self.cul.write("V\r\n")
+		self.assertTrue(read_line(self.cul).startswith("V "))
+		self.cul.write("X\r\n")
+		self.assertEqual(read_line(self.cul), "21  %i\r\n" % (MAX_BUDGET / 10))
+
+	def test_reports_and_acks(self):
+		self.cul._reports = [(0, 0x100000)]
+		report = read_line(self.cul)
+		msg = MoritzMessage.decode_message(report[:-4])
+		self.assertTrue(isinstance(msg, ThermostatStateMessage))
+		self.assertEqual(msg.sender_id, 0x100000)
+		self.assertTrue('measured_temperature' in msg.decoded_payload)
+
+		command = SetTemperatureMessage()
+		command.counter = 0x42
+		command.sender_id = CUBE_ID
+		command.receiver_id = 0x100000
+		self.cul.write(command.encode_message({'desired_temperature': 19.5, 'mode': 'manual'}) + "\r\n")
+		ack = MoritzMessage.decode_message(read_line(self.cul)[:-4])
+		self.assertTrue(isinstance(ack, AckMessage))
+		self.assertEqual(ack.counter, 0x42)
+		self.assertEqual(ack.receiver_id, CUBE_ID)
+		self.assertEqual(ack.decoded_payload['state'], "ok")
+		self.assertEqual(ack.decoded_payload['desired_temperature'], 19.5)
+		self.assertEqual(ack.decoded_payload['mode'], "manual")
+
+	def test_budget_overflow(self):
+		self.cul._budget = 0
+		self.cul.write("Zs0B0100F0123456100000000A\r\n")
+		self.assertEqual(read_line(self.cul), "LOVF\r\n")
+		self.assertEqual(self.cul.overflows, 1)
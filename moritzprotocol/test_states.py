@@ -0,0 +1,46 @@
+import unittest
+from datetime import datetime
+from .states import *
+
+
+class ThermostatStatesTestCase(unittest.TestCase):
+	def setUp(self):
+		self.states = ThermostatStates()
+		self.timestamp = datetime(2014, 12, 1, 10, 30, 15, 123456)
+
+	def test_update_reports_changes_only(self):
+		payload = {'mode': 'auto', 'valve_position': 10, 'measured_temperature': 20.2, 'is_locked': False}
+		self.assertEqual(self.states.update(1, payload, 0x20, self.timestamp), payload)
+		self.assertEqual(self.states.update(1, dict(payload, valve_position=12), 0x21), {'valve_position': 12})
+		self.assertEqual(self.states.update(1, {'state': 'ok', 'is_locked': True}, 0x21), {'state': 'ok', 'is_locked': True})
+		self.assertEqual(self.states.update(1, {'state': 'ok'}, 0x21), {})
+
+	def test_views_and_serialization(self):
+		self.states.update(0x8FFE9, {'mode': 'manual', 'desired_temperature': 21.5, 'battery_low': False}, 0x20, self.timestamp)
+		state = self.states[0x8FFE9]
+		self.assertEqual(state['last_updated'], self.timestamp)
+		self.assertEqual(state['desired_temperature'], 21.5)
+		self.assertEqual(state.get('measured_temperature'), None)
+		self.assertFalse('valve_position' in state)
+		self.assertEqual(dict(state), {
+			'last_updated': self.timestamp,
+			'signal_strenth': 0x20,
+			'mode': 'manual',
+			'desired_temperature': 21.5,
+			'battery_low': False,
+		})
+		self.assertEqual(self.states.as_dict(), {0x8FFE9: dict(state)})
+		self.assertTrue(0x8FFE9 in self.states)
+		self.assertEqual(self.states.get(0x123), None)
+
+	def test_columns(self):
+		self.states.update(1, {'mode': 'auto', 'valve_position': 10}, 0x20, self.timestamp)
+		self.states.update(2, {'mode': 'manual', 'is_locked': True}, None, self.timestamp)
+		columns = self.states.as_columns()
+		self.assertEqual(columns['sender_id'], [1, 2])
+		self.assertEqual(columns['mode'], ['auto', 'manual'])
+		self.assertEqual(columns['valve_position'], [10, None])
+		self.assertEqual(columns['is_locked'], [None, True])
+		self.assertEqual(columns['signal_strenth'], [0x20, None])
+		self.assertEqual(columns['last_updated'][0], to_epoch(self.timestamp))
+		self.assertEqual(self.states.as_dict(iso_dates=True)[1]['last_updated'], "2014-12-01T10:30:15.123456")
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from .storage import *
+
+
+STATE = {
+	'mode': 'manual',
+	'desired_temperature': 21.5,
+	'measured_temperature': 19.8,
+	'valve_position': 40,
+	'is_locked': True,
+	'battery_low': False,
+	'signal_strenth': 0x3A,
+}
+
+
+class SegmentStorageTestCase(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_roundtrip(self):
+		storage = SegmentStorage(self.path)
+		timestamp = datetime(2014, 12, 1, 10, 30, 15, 250000)
+		storage.store_state(0x123456, timestamp, STATE, {})
+		states = storage.query_states(0x123456, timestamp, timestamp)
+		self.assertEqual(len(states), 1)
+		self.assertEqual(states[0]['last_updated'], timestamp)
+		self.assertEqual(states[0]['mode'], 'manual')
+		self.assertEqual(states[0]['desired_temperature'], 21.5)
+		self.assertEqual(states[0]['measured_temperature'], 19.8)
+		self.assertEqual(states[0]['valve_position'], 40)
+		self.assertEqual(states[0]['signal_strength'], 0x3A)
+		self.assertTrue(states[0]['is_locked'])
+		self.assertFalse(states[0]['battery_low'])
+		self.assertEqual(storage.query_states(0x654321, timestamp, timestamp), [])
+
+	def test_range_across_segments(self):
+		storage = SegmentStorage(self.path, segment_records=4)
+		started = datetime(2014, 12, 1)
+		for minute in range(10):
+			storage.store_state(1, started + timedelta(minutes=minute), dict(STATE, valve_position=minute), {})
+		storage.close()
+		self.assertEqual(len(os.listdir(os.path.join(self.path, "000001"))), 3)
+
+		storage = SegmentStorage(self.path, segment_records=4)
+		states = storage.query_states(1, started + timedelta(minutes=3), started + timedelta(minutes=8))
+		self.assertEqual([state['valve_position'] for state in states], [3, 4, 5, 6, 7, 8])
+		storage.store_state(1, started + timedelta(minutes=10), STATE, {})
+		self.assertEqual(len(storage.query_states(1, started, started + timedelta(hours=1))), 11)
+		storage.close()
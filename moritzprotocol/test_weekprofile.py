@@ -0,0 +1,36 @@
+import unittest
+from .weekprofile import *
+
+
+class WeekProfileTestCase(unittest.TestCase):
+	def test_parse_day_profile(self):
+		self.assertEqual(parse_day_profile([("06:00", 17), ("22:00", 21.2), ("24:00", 17)]),
+			((360, 17.0), (1320, 21.0), (1440, 17.0)))
+
+	def test_parse_invalid_day_profile(self):
+		with self.assertRaises(InvalidWeekProfileError):
+			parse_day_profile([("06:00", 17)])
+		with self.assertRaises(InvalidWeekProfileError):
+			parse_day_profile([("06:03", 17), ("24:00", 17)])
+		with self.assertRaises(InvalidWeekProfileError):
+			parse_day_profile([("22:00", 17), ("06:00", 17), ("24:00", 17)])
+
+	def test_short_day_only_needs_first_part(self):
+		parts = day_parts(parse_day_profile([("06:00", 17), ("24:00", 21)]))
+		self.assertEqual(parts.keys(), [0])
+		self.assertEqual(len(parts[0]), 7)
+		self.assertEqual(parts[0][-1], (1440, 21.0))
+
+	def test_only_changed_parts(self):
+		profile = {
+			'monday': [("06:00", 17), ("24:00", 21)],
+			'tuesday': [("%02i:00" % hour, 17) for hour in range(1, 24)[::2]] + [("24:00", 21)],
+		}
+		changes = changed_parts({}, profile)
+		self.assertEqual([(day, part) for day, part, entries in changes],
+			[('monday', 0), ('tuesday', 0), ('tuesday', 1)])
+
+		confirmed = dict(((day, part), entries) for day, part, entries in changes)
+		profile['tuesday'][-2] = ("23:00", 19)
+		self.assertEqual([(day, part) for day, part, entries in changed_parts(confirmed, profile)],
+			[('tuesday', 1)])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    moritzprotocol.weekprofile
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Week profile handling. A day holds up to 13 switch points which are transferred
+    in two ConfigWeekProfileMessage parts (7 + 6 switch points). To save send budget,
+    only parts differing from the last confirmed profile of a device are sent.
+
+    :copyright: (c) 2014 by Markus Ullmann.
+    :license: BSD, see LICENSE for more details.
+"""
+
+# environment constants
+
+# python imports
+
+# environment imports
+
+# custom imports
+from moritzprotocol.exceptions import InvalidWeekProfileError
+from moritzprotocol.messages import WEEKDAYS
+
+# local constants
+MAX_ENTRIES_PER_DAY = 13
+ENTRIES_PER_PART = 7
+END_OF_DAY = 24 * 60
+
+
+def parse_day_profile(entries):
+    """Normalizes list of (until, temperature) switch points of a day.
+
+    until may be given as minutes since midnight or as "HH:MM" string, last switch point has to end at 24:00.
+    Returns tuple of (until minutes, temperature) tuples.
+    """
+
+    result = []
+    for until, temperature in entries:
+        if not isinstance(until, int):
+            hours, minutes = until.split(":")
+            until = int(hours) * 60 + int(minutes)
+        if until % 5 or not 0 < until <= END_OF_DAY:
+            raise InvalidWeekProfileError("Switch point %s has to be within the day in steps of 5 minutes" % until)
+        if result and until <= result[-1][0]:
+            raise InvalidWeekProfileError("Switch points have to be in ascending order")
+        temperature = min(max(round(float(temperature)*2)/2.0, 4.5), 30.5)
+        result.append((until, temperature))
+    if not result or result[-1][0] != END_OF_DAY:
+        raise InvalidWeekProfileError("Last switch point has to end at 24:00")
+    if len(result) > MAX_ENTRIES_PER_DAY:
+        raise InvalidWeekProfileError("At most %i switch points per day supported" % MAX_ENTRIES_PER_DAY)
+    return tuple(result)
+
+
+def day_parts(entries):
+    """Splits normalized switch points of a day into message parts as {part: entries}.
+
+    Unused slots are padded with the last switch point like the MAX!Cube does. The
+    second part is only needed if the first part does not reach the end of day.
+    """
+
+    padded = entries + (entries[-1],) * (MAX_ENTRIES_PER_DAY - len(entries))
+    parts = {0: padded[:ENTRIES_PER_PART]}
+    if len(entries) > ENTRIES_PER_PART:
+        parts[1] = padded[ENTRIES_PER_PART:]
+    return parts
+
+
+def changed_parts(confirmed, profile):
+    """Returns sorted list of (day, part, entries) from profile differing from confirmed parts.
+
+    profile maps day names to switch points, days not mentioned are left untouched.
+    confirmed maps (day, part) to the entries the device acknowledged before.
+    """
+
+    result = []
+    for day, entries in profile.items():
+        if day not in WEEKDAYS:
+            raise InvalidWeekProfileError("Unknown day %s" % day)
+        for part, part_entries in day_parts(parse_day_profile(entries)).items():
+            if confirmed.get((day, part)) != part_entries:
+                result.append((day, part, part_entries))
+    result.sort(key=lambda change: (WEEKDAYS.index(change[0]), change[1]))
+    return result